@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
-import sys, os, time, shutil
+import sys, os, time, shutil, base64, threading, contextlib, io, json
+import sqlite3, zlib, subprocess, shlex, itertools
 sys.dont_write_bytecode = True
 
 try:
@@ -8,10 +9,30 @@ try:
 except ModuleNotFoundError:
   pass
 
+try:
+  import fcntl
+except ModuleNotFoundError:
+  fcntl = None
+
 import missioncontrollitelib
 missioncontrollitelib.DEFAULT_CONFIG_ENV_VAR_NAME = 'MCLITE_CLIENT_CONFIG'
 from missioncontrollitelib import *
 
+DEFAULT_STDIN_CHUNK_SIZE = 64*1024
+DEFAULT_WAIT_TIMEOUT = 600
+DEFAULT_WAKE_STATE_NAME = 'wake_state.json'
+DEFAULT_RESULT_STORE_NAME = 'results.sqlite3'
+DEFAULT_RESULT_STORE_MAX_AGE = 30*24*60*60
+DEFAULT_RESULT_STORE_MAX_BYTES = 64*1024*1024
+DEFAULT_HISTORY_LIMIT = 10
+DEFAULT_PAGER = 'less'
+DEFAULT_LESS = 'FRX'
+RETURN_CODE_PREFIX = 'RETURN CODE: '
+# Longer than the Bus' own long-poll timeout, see the Waker's timeout
+DEFAULT_REQUEST_TIMEOUT = 180
+
+_pool = missioncontrollitelib.ConnectionPool(timeout = DEFAULT_REQUEST_TIMEOUT)
+
 def send(device, payload, waker = False):
   bus = get_config()['mcbus_url']
   key = get_config()['devices'][device]['client_key']
@@ -21,45 +42,378 @@ def send(device, payload, waker = False):
     return
   try:
     missioncontrollitelib.send(bus, recipient, key, payload,
-                              verify = get_cert_path())
+                              verify = get_cert_path(), pool = _pool)
+    return True
   except Exception as exc:
     print('Error: ' + repr(exc))
+    return False
 
-def get_inbox(name, device):
+def send_stdin(device, sender, stream_id, f):
+  chunk_size = get_config().get('stdin_chunk_size', DEFAULT_STDIN_CHUNK_SIZE)
+  seq = 0
+  data = f.read(chunk_size)
+  while True:
+    nxt = f.read(chunk_size) if data else b''
+    if not send(device, {
+        'sender': sender,
+        'stdin_stream': stream_id,
+        'seq': seq,
+        'data': base64.b85encode(data).decode(),
+        'eof': not nxt,
+    }):
+      return False
+    print(f'Sent stdin chunk #{seq+1}')
+    if not nxt:
+      return True
+    seq += 1
+    data = nxt
+
+def get_inbox(name, device, timeout = None):
+  request_timeout = get_config().get('request_timeout',
+                                     DEFAULT_REQUEST_TIMEOUT)
   inbox = missioncontrollitelib.receive(
     get_config()['mcbus_url'],
     name,
     verify = get_cert_path(),
+    pool = _pool,
+    timeout = request_timeout if timeout is None else \
+              min(timeout, request_timeout),
   )
   key = get_config()['devices'][device]['server_key']
-  return [missioncontrollitelib.decrypt(i, key) for i in inbox]
+  messages = []
+  for i in inbox:
+    message = missioncontrollitelib.decrypt(i, key)
+    if type(message) is dict and 'messages' in message:
+      messages.extend(message['messages'])
+    else:
+      messages.append(message)
+  return messages
+
+def get_cache_dir():
+  return os.path.join(
+    os.environ.get(
+      'XDG_CACHE_HOME',
+      os.path.join(os.path.expanduser('~'), '.cache'),
+    ),
+    DEFAULT_NAMESPACES[0],
+  )
 
-def wake(state):
+def get_wake_state_path():
+  if path := get_config().get('wake_state_path'):
+    return path
+  return os.path.join(get_cache_dir(), DEFAULT_WAKE_STATE_NAME)
+
+def get_wake_state(device):
+  try:
+    with open(get_wake_state_path(), 'r') as f:
+      return json.load(f).get(device, {})
+  except (OSError, ValueError, AttributeError):
+    return {}
+
+def update_wake_state(device, **kwargs):
+  path = get_wake_state_path()
+  try:
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    with open(path + '.lock', 'a') as lock:
+      if fcntl:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+      try:
+        with open(path, 'r') as f:
+          wake_state = json.load(f)
+      except (FileNotFoundError, ValueError):
+        wake_state = {}
+      entry = wake_state.setdefault(device, {})
+      for k, v in kwargs.items():
+        entry[k] = max(entry.get(k, 0), v)
+      tmp_path = f'{path}.{os.getpid()}.tmp'
+      with open(tmp_path, 'w') as f:
+        json.dump(wake_state, f)
+      os.replace(tmp_path, path)
+  except OSError as exc:
+    print('Unable to update wake state: ' + repr(exc))
+
+def wake(state, report = print):
   missing = object()
   dev = state['device']
   waker_name = get_config()['devices'][dev].get('waker_name', missing)
   if waker_name is not None:
-    print('Waking server via bus...\n')
+    report('Waking server via bus...\n')
     send(dev, 'wake', waker = True)
   elif waker_url := get_config()['devices'][dev].get('waker_url', missing):
-    print('Waking server via custom URL...\n')
+    report('Waking server via custom URL...\n')
     cert = get_config()['devices'][dev].get('waker_cert', missing)
     if cert is missing:
       cert = get_cert_path()
     missioncontrollitelib.request(waker_url, verify = cert)
   state['last_wake'] = time.time()
+  update_wake_state(dev, last_wake = state['last_wake'])
 
-def wake_if_idle(state):
+def wake_if_idle(state, report = print):
   idle_timeout = get_config().get('idle_timeout', DEFAULT_IDLE_TIMEOUT)
-  last_wake = state.get('last_wake', 0)
-  if (time.time() - last_wake) > idle_timeout:
-    wake(state)
+  wake_state = get_wake_state(state['device'])
+  # A reply doesn't keep the Server awake, only requests it receives do
+  last_seen = max(state.get('last_wake', 0),
+                  wake_state.get('last_wake', 0),
+                  wake_state.get('last_request', 0))
+  if (time.time() - last_seen) > idle_timeout:
+    wake(state, report)
+
+def start_wake(state):
+  # Status is queued for report_wake so it isn't printed over a prompt
+  status = state.setdefault('wake_status', [])
+  def run():
+    try:
+      wake_if_idle(state, status.append)
+    except Exception as exc:
+      status.append('Error: ' + repr(exc))
+  waker = state.get('waker')
+  if waker is None or not waker.is_alive():
+    waker = threading.Thread(target = run, daemon = True)
+    state['waker'] = waker
+    waker.start()
+  return waker
+
+def report_wake(state):
+  status = state.get('wake_status', [])
+  while status:
+    print(status.pop(0))
+
+def get_return_code(message):
+  for section in message.get('sections', []):
+    title = section.get('title', '')
+    if title.startswith(RETURN_CODE_PREFIX):
+      rc = title[len(RETURN_CODE_PREFIX):]
+      return int(rc) if rc.lstrip('-').isdigit() else rc
+    if title == 'Error':
+      return title
+  return None
+
+def iter_message_lines(inbox, start = 1):
+  w = lambda: shutil.get_terminal_size()[0]
+  for idx, message in enumerate(inbox):
+    yield f'Message #{idx+start}'
+    for section in message.get('sections', []):
+      yield from iwrap(section['title'], width = w, indent = (2*' '))
+      if body := section.get('body'):
+        yield from iwrap(body, width = w, indent = (4*' '))
+    yield ''
+
+def print_messages(inbox, start = 1):
+  for line in iter_message_lines(inbox, start = start):
+    print(line)
+
+def page_lines(lines):
+  pager = get_config().get('pager', os.environ.get('PAGER', DEFAULT_PAGER))
+  height = shutil.get_terminal_size()[1]
+  lines = iter(lines)
+  if pager and sys.stdin.isatty() and sys.stdout.isatty():
+    head = list(itertools.islice(lines, height))
+    lines = itertools.chain(head, lines)
+    if len(head) >= height:
+      env = dict(os.environ)
+      env.setdefault('LESS', DEFAULT_LESS)
+      try:
+        proc = subprocess.Popen(shlex.split(pager), env = env,
+                                stdin = subprocess.PIPE, text = True,
+                                errors = 'replace')
+      except OSError as exc:
+        print('Unable to start pager: ' + repr(exc))
+      else:
+        try:
+          with proc.stdin:
+            for line in lines:
+              proc.stdin.write(line + '\n')
+        except (BrokenPipeError, KeyboardInterrupt):
+          pass
+        proc.wait()
+        return
+  for line in lines:
+    print(line)
+
+def get_message_text(message):
+  return '\n'.join(section.get('title', '') + '\n' + section.get('body', '')
+                   for section in message.get('sections', []))
+
+def get_message_pid(message):
+  for section in message.get('sections', []):
+    if section.get('title') == 'PID':
+      return section.get('body')
+  return None
+
+def open_result_store():
+  path = get_config().get('result_store_path')
+  if path is None:
+    path = os.path.join(get_cache_dir(), DEFAULT_RESULT_STORE_NAME)
+  if not path:
+    return None
+  os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+  db = sqlite3.connect(path, timeout = 30)
+  db.create_function('message_text', 1, lambda body:
+    get_message_text(json.loads(zlib.decompress(body))))
+  db.execute('PRAGMA journal_mode = WAL')
+  db.executescript('''
+    CREATE TABLE IF NOT EXISTS results (
+      id INTEGER PRIMARY KEY,
+      device TEXT NOT NULL,
+      command_name TEXT,
+      pid TEXT,
+      time REAL NOT NULL,
+      return_code TEXT,
+      size INTEGER NOT NULL,
+      body BLOB NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS results_by_command
+      ON results (device, command_name, id);
+    CREATE INDEX IF NOT EXISTS results_by_time ON results (time);
+    CREATE INDEX IF NOT EXISTS results_by_return_code
+      ON results (return_code);
+  ''')
+  try:
+    # Contentless, the text is only kept compressed in results
+    db.execute('CREATE VIRTUAL TABLE IF NOT EXISTS results_fts ' +
+               "USING fts5(text, content = '')")
+  except sqlite3.OperationalError:
+    pass
+  return db
+
+def has_fts(db):
+  return db.execute('SELECT 1 FROM sqlite_master ' +
+                    "WHERE name = 'results_fts'").fetchone() is not None
+
+def prune_results(db, fts):
+  max_age = get_config().get('result_store_max_age',
+                             DEFAULT_RESULT_STORE_MAX_AGE)
+  max_bytes = get_config().get('result_store_max_bytes',
+                               DEFAULT_RESULT_STORE_MAX_BYTES)
+  rows = db.execute('''
+    SELECT id, body FROM results WHERE time < ? OR id IN (
+      SELECT id FROM (
+        SELECT id, SUM(size) OVER (ORDER BY id DESC) - size AS total
+        FROM results
+      ) WHERE total > ?
+    )
+  ''', (time.time() - max_age, max_bytes)).fetchall()
+  for row_id, body in rows:
+    if fts:
+      text = get_message_text(json.loads(zlib.decompress(body)))
+      db.execute('INSERT INTO results_fts (results_fts, rowid, text) ' +
+                 "VALUES ('delete', ?, ?)", (row_id, text))
+    db.execute('DELETE FROM results WHERE id = ?', (row_id,))
+
+def store_messages(device, messages, command_name = None):
+  try:
+    if (db := open_result_store()) is None:
+      return
+    with contextlib.closing(db), db:
+      fts = has_fts(db)
+      now = time.time()
+      for message in messages:
+        body = zlib.compress(json.dumps(message).encode())
+        rc = get_return_code(message)
+        cur = db.execute('''
+          INSERT INTO results
+            (device, command_name, pid, time, return_code, size, body)
+          VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (device, message.get('command_name', command_name),
+              get_message_pid(message), now, None if rc is None else str(rc),
+              len(body), body))
+        if fts:
+          db.execute('INSERT INTO results_fts (rowid, text) VALUES (?, ?)',
+                     (cur.lastrowid, get_message_text(message)))
+      prune_results(db, fts)
+  except (OSError, sqlite3.Error) as exc:
+    print('Unable to store results: ' + repr(exc))
+
+def query_results(device = None, command_name = None, search = None,
+                  return_code = None, limit = DEFAULT_HISTORY_LIMIT):
+  if (db := open_result_store()) is None:
+    return []
+  with contextlib.closing(db):
+    where = []
+    params = []
+    for column, value in (('device', device),
+                          ('command_name', command_name),
+                          ('return_code', return_code)):
+      if value is not None:
+        where.append(f'{column} = ?')
+        params.append(str(value))
+    if search and has_fts(db):
+      where.append('id IN (SELECT rowid FROM results_fts ' +
+                   'WHERE results_fts MATCH ?)')
+      params.append('"' + search.replace('"', '""') + '"')
+    elif search:
+      where.append("message_text(body) LIKE ? ESCAPE '\\'")
+      params.append('%' + search.replace('\\', '\\\\')
+                                .replace('%', '\\%')
+                                .replace('_', '\\_') + '%')
+    rows = db.execute(
+      'SELECT device, command_name, time, body, pid, return_code ' +
+      'FROM results ' + ('WHERE ' + ' AND '.join(where) if where else '') +
+      ' ORDER BY id DESC LIMIT ?', params + [limit],
+    )
+    return [(r[0], r[1], r[2], json.loads(zlib.decompress(r[3])))
+            for r in reversed(rows.fetchall())]
+
+def get_last_run(device, command_name):
+  if (db := open_result_store()) is None:
+    return []
+  with contextlib.closing(db):
+    rows = db.execute('''
+      SELECT device, command_name, time, body, pid, return_code
+      FROM results WHERE device = ? AND command_name = ? ORDER BY id DESC
+    ''', (device, command_name))
+    run = []
+    for row in rows:
+      if run and (row[4] != run[0][4] or row[5] is not None):
+        break
+      run.append(row)
+    return [(r[0], r[1], r[2], json.loads(zlib.decompress(r[3])))
+            for r in reversed(run)]
+
+def iter_result_lines(results):
+  for idx, (device, command_name, t, message) in enumerate(results):
+    yield (f'{device} / {command_name}, ' +
+           time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t)))
+    yield from iter_message_lines([message], start = idx+1)
+
+def print_results(results):
+  page_lines(iter_result_lines(results))
+
+def receive_messages(state, timeout = None):
+  inbox = get_inbox(state['name'], state['device'], timeout = timeout)
+  pending = state.setdefault('pending_sends', [])
+  if inbox and pending:
+    # A reply means the Server received one of our pending commands, which
+    # can't have been sent before the oldest of them
+    update_wake_state(state['device'], last_request = min(pending))
+  for message in inbox:
+    if get_return_code(message) is not None:
+      state['outstanding'] = max(state.get('outstanding', 0) - 1, 0)
+      if pending:
+        pending.remove(min(pending))
+  if inbox:
+    store_messages(state['device'], inbox, state.get('last_command'))
+  return inbox
+
+def follow_messages(state, deadline = None):
+  while state.get('outstanding', 0) > 0:
+    timeout = None
+    if deadline is not None and (timeout := deadline - time.time()) <= 0:
+      return
+    try:
+      inbox = receive_messages(state, timeout = timeout)
+    except OSError:
+      # A poll cut short by the deadline ends following rather than failing
+      if deadline is not None and time.time() >= deadline:
+        return
+      raise
+    yield from inbox
 
 def check_inbox(state):
   print('Getting inbox...')
   print('')
   try:
-    inbox = get_inbox(state['name'], state['device'])
+    inbox = receive_messages(state)
   except KeyboardInterrupt:
     print('Interrupted!')
     inbox = []
@@ -68,18 +422,63 @@ def check_inbox(state):
     inbox = []
   print(f'Got {len(inbox)} message(s)')
   print('')
-  w = shutil.get_terminal_size()[0]
-  for idx, message in enumerate(inbox):
-    print(f'Message #{idx+1}')
-    for section in message.get('sections', []):
-      print(wrap(section['title'], width = w, indent = (2*' ')))
-      if body := section.get('body'):
-        print(wrap(body, width = w, indent = (4*' ')))
+  page_lines(iter_message_lines(inbox))
+
+def follow_inbox(state):
+  if not state.get('outstanding'):
+    return check_inbox(state)
+  print(f"Waiting for {state['outstanding']} command(s) to finish, " +
+        'press Ctrl-C to stop...')
+  print('')
+  count = 0
+  try:
+    for message in follow_messages(state):
+      count += 1
+      if count == 1 and (sent := state.get('last_send')):
+        print(f'First reply after {time.time() - sent:.2f}s')
+        print('')
+      print_messages([message], start = count)
+  except KeyboardInterrupt:
+    print('Interrupted!')
+    print('')
+  except Exception as exc:
+    print('Error: ' + repr(exc))
+    print('')
+  print(f'Got {count} message(s)')
+  print('')
+
+def send_command(state, command_name, args = None, stdin = None,
+                 stdin_file = None):
+  payload = {
+    'command_name': command_name,
+    'sender': state['name'],
+    'args': args or {},
+    'stdin': stdin,
+  }
+  if stdin_file:
+    payload['stdin_stream'] = token(16)
+  try:
+    state['last_send'] = time.time()
+    state['last_command'] = command_name
+    if not send(state['device'], payload):
+      return False
+    state['outstanding'] = state.get('outstanding', 0) + 1
+    state.setdefault('pending_sends', []).append(state['last_send'])
+    if stdin_file:
+      ok = send_stdin(state['device'], state['name'],
+                      payload['stdin_stream'], stdin_file)
+      print('')
+      return ok
+    return True
+  except OSError as exc:
+    print('Error: ' + repr(exc))
     print('')
+    return False
 
 def device_menu(state):
   while True:
-    wake_if_idle(state)
+    start_wake(state)
+    report_wake(state)
     print(' -= Device Menu =- ')
     print('')
     print(f'Current Device: {state['device']}')
@@ -88,21 +487,49 @@ def device_menu(state):
     choices = [(idx+1, i) for idx, i in enumerate(commands.keys())]
     i = ask(choices + [
       ('i', 'Check Inbox'),
+      ('f', 'Follow Inbox'),
+      ('h', 'History'),
+      ('s', 'Server Stats'),
       ('w', 'Wake Again'),
       ('q', 'Quit'),
     ])
+    report_wake(state)
     if i == 'q':
+      state['waker'].join()
       return
     elif i == 'w':
+      state['waker'].join()
       wake(state)
       continue
     elif i == 'i':
-      wake(state)
+      start_wake(state)
+      check_inbox(state)
+      continue
+    elif i == 'f':
+      start_wake(state)
+    elif i == 'h':
+      print('Enter a command name (leave blank for all commands):')
+      command_name = input('> ') or None
+      print('Enter text to search for (leave blank to show the latest):')
+      search = input('> ') or None
+      print('')
+      try:
+        print_results(query_results(state['device'], command_name, search))
+      except sqlite3.Error as exc:
+        print('Error: ' + repr(exc))
+        print('')
+      continue
+    elif i == 's':
+      start_wake(state)
+      print('Requesting server stats...')
+      print('')
+      send_command(state, STATS_COMMAND_NAME)
     else:
       command_name = dict(choices)[int(i)]
       command = commands[command_name]
       args = {}
       stdin = None
+      stdin_path = None
       if type(command) is dict:
         for arg in command.get('args', []):
           print(f'Enter value for "{arg}":')
@@ -110,6 +537,11 @@ def device_menu(state):
           args[arg] = inp
           print('')
         if command.get('accepts_stdin'):
+          print('Enter a file or pipe to upload as stdin ' +
+                '(leave blank to type stdin instead):')
+          stdin_path = input('> ')
+          print('')
+        if command.get('accepts_stdin') and not stdin_path:
           print('Enter EOF string for stdin:')
           eof = input('> ')
           print('Enter stdin:')
@@ -126,16 +558,23 @@ def device_menu(state):
             stdin = '\n'.join(stdin) + '\n'
           else:
             stdin = ''
-      wake_if_idle(state)
+      stdin_file = None
+      if stdin_path:
+        try:
+          stdin_file = open(os.path.expanduser(stdin_path), 'rb')
+        except OSError as exc:
+          print('Error: ' + repr(exc))
+          print('')
+          continue
+      start_wake(state)
       print('Sending request...')
       print('')
-      send(state['device'],{
-          'command_name': command_name,
-          'sender': state['name'],
-          'args': args,
-          'stdin': stdin,
-      })
-    check_inbox(state)
+      try:
+        send_command(state, command_name, args, stdin, stdin_file)
+      finally:
+        if stdin_file:
+          stdin_file.close()
+    follow_inbox(state)
 
 def main_menu():
   try_set_comm('MCLite-Client')
@@ -155,5 +594,145 @@ def main_menu():
     }
     device_menu(state)
 
+def run_on_device(device, command_name, args, stdin, wait, deadline, result):
+  state = {'name': f'mclite_client_{token()}', 'device': device}
+  try:
+    start_wake(state)
+    with (stdin() if stdin else contextlib.nullcontext()) as stdin_file:
+      result['sent'] = send_command(state, command_name, args,
+                                    stdin_file = stdin_file)
+    if not wait:
+      return
+    for message in follow_messages(state, deadline):
+      result['messages'].append(message)
+      if (rc := get_return_code(message)) is not None:
+        result['return_code'] = rc
+    result['timed_out'] = state.get('outstanding', 0) > 0
+  except Exception as exc:
+    result['error'] = repr(exc)
+  finally:
+    state['waker'].join()
+    report_wake(state)
+
+def cli_run(cli_args):
+  positional = []
+  args = {}
+  stdin_path = None
+  as_json = False
+  wait = False
+  timeout = DEFAULT_WAIT_TIMEOUT
+  it = iter(cli_args)
+  for arg in it:
+    if arg == '--arg':
+      k, _, v = next(it).partition('=')
+      args[k] = v
+    elif arg == '--stdin':
+      stdin_path = next(it)
+    elif arg == '--timeout':
+      timeout = float(next(it))
+    elif arg == '--json':
+      as_json = True
+    elif arg == '--wait':
+      wait = True
+    elif arg.startswith('--'):
+      raise ValueError(f'Invalid option: {arg}')
+    else:
+      positional.append(arg)
+  if len(positional) < 2:
+    raise ValueError('Usage: run DEVICE... COMMAND [--arg K=V]... ' +
+                     '[--stdin FILE] [--wait] [--timeout SECONDS] [--json]')
+  *devices, command_name = positional
+  for device in devices:
+    if device not in get_config().get('devices', {}):
+      raise ValueError(f'Invalid device: {device}')
+  stdin = None
+  if stdin_path == '-':
+    data = sys.stdin.buffer.read()
+    stdin = lambda: io.BytesIO(data)
+  elif stdin_path:
+    stdin = lambda: open(os.path.expanduser(stdin_path), 'rb')
+  deadline = time.time() + timeout
+  results = {}
+  threads = []
+  out = sys.stdout
+  with contextlib.redirect_stdout(sys.stderr):
+    for device in devices:
+      results[device] = {
+        'sent': False,
+        'return_code': None,
+        'timed_out': False,
+        'error': None,
+        'messages': [],
+      }
+      threads.append(threading.Thread(target = run_on_device, args = (
+        device, command_name, args, stdin, wait, deadline, results[device],
+      )))
+      threads[-1].start()
+    for thread in threads:
+      thread.join()
+  if as_json:
+    json.dump(results, out, indent = 2)
+    out.write('\n')
+  else:
+    for device, result in results.items():
+      print(f'{device}:')
+      print('')
+      if result['error']:
+        print('Error: ' + result['error'])
+      elif result['timed_out']:
+        print('Timed out waiting for a return code')
+      print_messages(result['messages'])
+  ok = all((r['sent'] and (r['return_code'] == 0 if wait else True)
+            for r in results.values()))
+  return 0 if ok else 1
+
+def cli_history(cli_args):
+  kwargs = {}
+  last = False
+  as_json = False
+  it = iter(cli_args)
+  for arg in it:
+    if arg == '--device':
+      kwargs['device'] = next(it)
+    elif arg == '--command':
+      kwargs['command_name'] = next(it)
+    elif arg == '--search':
+      kwargs['search'] = next(it)
+    elif arg == '--return-code':
+      kwargs['return_code'] = next(it)
+    elif arg == '--limit':
+      kwargs['limit'] = int(next(it))
+    elif arg == '--last':
+      last = True
+    elif arg == '--json':
+      as_json = True
+    else:
+      raise ValueError(f'Invalid option: {arg}')
+  if last:
+    if 'device' not in kwargs or 'command_name' not in kwargs:
+      raise ValueError('--last requires --device and --command')
+    results = get_last_run(kwargs['device'], kwargs['command_name'])
+  else:
+    results = query_results(**kwargs)
+  if as_json:
+    json.dump([{'device': device, 'command_name': command_name, 'time': t,
+                'message': message}
+               for device, command_name, t, message in results],
+              sys.stdout, indent = 2)
+    sys.stdout.write('\n')
+  else:
+    print_results(results)
+  return 0 if results else 1
+
+def main():
+  if len(sys.argv) < 2:
+    return main_menu()
+  try_set_comm('MCLite-Client')
+  if sys.argv[1] == 'run':
+    return cli_run(sys.argv[2:])
+  elif sys.argv[1] == 'history':
+    return cli_history(sys.argv[2:])
+  raise ValueError(f'Invalid command: {sys.argv[1]}')
+
 if __name__ == '__main__':
-  main_menu()
+  sys.exit(main())
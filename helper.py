@@ -12,32 +12,203 @@ DBUS_SEARCH_PATHS = (
   '/run/user',
 )
 XDG_RUNTIME_SEARCH_PATHS = DBUS_SEARCH_PATHS
+SESSION_ENV_CACHE_NAME = 'session_env.json'
 VALID_CONTAINERS_NAME_CHARS = 'abcdefghijklmnopqrstuvwxyz_' + \
                               'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
 DEFAULT_CONTAINER_ENGINES = ('podman', 'docker')
 DEFAULT_CONTAINER_PREFIX = 'mclite_'
 DEFAULT_CONTAINER_SHELL = '/bin/sh'
+DEFAULT_CONTAINER_BACKEND = 'auto'
+DEFAULT_CONTAINER_API_TIMEOUT = 300
+DEFAULT_CONTAINER_API_WORKERS = 4
+# rootless socket for a user first, then the system-wide socket for root
+CONTAINER_API_SOCKETS = {
+  'podman': ('/run/user/{uid}/podman/podman.sock', '/run/podman/podman.sock'),
+  'docker': ('/run/user/{uid}/docker.sock', '/var/run/docker.sock'),
+}
+CONTAINER_API_ACTIONS = {
+  'start': ('POST', '/containers/{}/start'),
+  'stop': ('POST', '/containers/{}/stop'),
+  'rm': ('DELETE', '/containers/{}'),
+}
+DEFAULT_TOP_INTERVAL = 1
+DEFAULT_TOP_COUNT = 10
+TOP_SORT_KEYS = ('cpu', 'rss', 'io')
+DEFAULT_LOGIN_TIMEOUT = 120
+LOGIND_SESSIONS_PATH = '/run/systemd/sessions'
+SESSION_POLL_INTERVAL = 1
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+PS_COLUMNS = ('rss', 'cpu', 'state', 'start')
+
+def read_proc_file(path):
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    chunks = []
+    while chunk := os.read(fd, 65536):
+      chunks.append(chunk)
+    return b''.join(chunks)
+  finally:
+    os.close(fd)
+
+def get_proc_stat(pid):
+  stat = read_proc_file(f'/proc/{pid}/stat')
+  # comm is in parentheses and may itself contain spaces or parentheses
+  fields = stat[stat.rindex(b')')+2:].split()
+  return {
+    'comm': stat[stat.index(b'(')+1:stat.rindex(b')')].decode(
+      errors = 'replace'),
+    'state': fields[0].decode(),
+    'utime': int(fields[11]),
+    'stime': int(fields[12]),
+    'starttime': int(fields[19]),
+    'rss': int(fields[21]),
+  }
+
+def get_boot_time():
+  for line in read_proc_file('/proc/stat').splitlines():
+    if line.startswith(b'btime '):
+      return int(line.split()[1])
+  return 0
+
+def format_proc_columns(stat, columns, boot_time):
+  import time
+  tick = os.sysconf('SC_CLK_TCK')
+  lines = []
+  if 'rss' in columns:
+    lines.append(f"RSS: {stat['rss'] * os.sysconf('SC_PAGE_SIZE') // 1024} KiB")
+  if 'cpu' in columns:
+    lines.append(f"CPU: {(stat['utime'] + stat['stime']) / tick:.2f}s")
+  if 'state' in columns:
+    lines.append(f"STATE: {stat['state']}")
+  if 'start' in columns:
+    start = boot_time + stat['starttime'] / tick
+    lines.append('START: ' + time.strftime('%Y-%m-%d %H:%M:%S',
+                                           time.localtime(start)))
+  return lines
+
+def get_proc_io(pid):
+  try:
+    io = dict(line.split(b': ') for line in
+              read_proc_file(f'/proc/{pid}/io').splitlines())
+    return int(io[b'read_bytes']), int(io[b'write_bytes'])
+  except PermissionError:
+    return None
+
+def take_snapshot():
+  procs = {}
+  for pid in os.listdir('/proc'):
+    if not pid.isdigit():
+      continue
+    try:
+      procs[pid] = (get_proc_stat(pid), get_proc_io(pid))
+    except (FileNotFoundError, ProcessLookupError):
+      pass
+  cpu = read_proc_file('/proc/stat').split(b'\n', 1)[0].split()[1:9]
+  cpu = list(map(int, cpu))
+  return procs, sum(cpu), cpu[3] + cpu[4]
+
+def top(named_args):
+  import time, shlex
+  interval = float(named_args.get('interval', DEFAULT_TOP_INTERVAL))
+  count = int(named_args.get('count', DEFAULT_TOP_COUNT))
+  sort = named_args.get('sort', TOP_SORT_KEYS[0])
+  if sort not in TOP_SORT_KEYS:
+    raise ValueError(f'Invalid sort: {sort}\n' +
+                     f"Valid sorts: {', '.join(TOP_SORT_KEYS)}")
+  start = time.monotonic()
+  before, before_total, before_idle = take_snapshot()
+  time.sleep(interval)
+  after, after_total, after_idle = take_snapshot()
+  elapsed = time.monotonic() - start
+  tick = os.sysconf('SC_CLK_TCK')
+  page_size = os.sysconf('SC_PAGE_SIZE')
+  rows = []
+  for pid, (stat, io) in after.items():
+    old_stat, old_io = before.get(pid, (None, None))
+    if old_stat and old_stat['starttime'] != stat['starttime']:
+      old_stat = old_io = None
+    cpu = stat['utime'] + stat['stime']
+    if old_stat:
+      cpu -= old_stat['utime'] + old_stat['stime']
+    read = write = None
+    if io and old_io:
+      read = (io[0] - old_io[0]) / elapsed
+      write = (io[1] - old_io[1]) / elapsed
+    rows.append({
+      'pid': int(pid),
+      'cpu': 100 * cpu / tick / elapsed,
+      'rss': stat['rss'] * page_size,
+      'io': (read or 0) + (write or 0),
+      'read': read,
+      'write': write,
+      'state': stat['state'],
+      'comm': stat['comm'],
+    })
+  rows.sort(key = lambda i: (i[sort], i['cpu'], i['rss']), reverse = True)
+
+  meminfo = {}
+  for line in read_proc_file('/proc/meminfo').splitlines():
+    k, _, v = line.partition(b':')
+    meminfo[k.decode()] = int(v.split()[0])
+  total = max(after_total - before_total, 1)
+  busy = 100 * (1 - (after_idle - before_idle) / total)
+  used = meminfo['MemTotal'] - meminfo.get('MemAvailable', meminfo['MemFree'])
+  print(f'CPU: {busy:.1f}% of {os.cpu_count()} cores, ' +
+        f"MEM: {used // 1024}/{meminfo['MemTotal'] // 1024} MiB, " +
+        f"SWAP: {(meminfo['SwapTotal'] - meminfo['SwapFree']) // 1024} MiB, " +
+        f"LOAD: {' '.join(f'{i:.2f}' for i in os.getloadavg())}, " +
+        f'PROCS: {len(after)}')
+  print('')
+  print(f"{'PID':>7} {'CPU%':>6} {'RSS MiB':>8} {'R KiB/s':>8} " +
+        f"{'W KiB/s':>8} S COMMAND")
+  kib = lambda i: '-' if i is None else f'{i / 1024:.0f}'
+  for row in rows[:count]:
+    try:
+      args = read_proc_file(f"/proc/{row['pid']}/cmdline")
+      args = args.decode(errors = 'replace').split('\0')[:-1]
+      cmd = shlex.join(args) if args else f"[{row['comm']}]"
+    except (FileNotFoundError, ProcessLookupError):
+      cmd = f"[{row['comm']}]"
+    print(f"{row['pid']:>7} {row['cpu']:>6.1f} " +
+          f"{row['rss'] / 1048576:>8.1f} {kib(row['read']):>8} " +
+          f"{kib(row['write']):>8} {row['state']} {cmd[:100]}")
 
 def ps(named_args):
+  import re, shlex
   matches = set()
   margs = named_args.get('match', [])
   if type(margs) is str:
     margs = [margs]
   for marg in margs:
     matches.update(map(str.strip, marg.split(',')))
+  columns = named_args.get('columns', '')
+  columns = [i for i in map(str.strip, columns.split(',')) if i]
+  for column in columns:
+    if column not in PS_COLUMNS:
+      raise ValueError(f'Invalid column: {column}\n' +
+                       f"Valid columns: {', '.join(PS_COLUMNS)}")
+  if not matches:
+    return
+  pattern = '|'.join(map(re.escape, sorted(matches)))
   results = {}
-  import shlex
   try:
+    # Matching the raw cmdline with NULs as spaces avoids decoding and
+    # quoting the cmdline of every process which doesn't match
+    bpattern = re.compile(pattern.encode())
     for pid in os.listdir('/proc'):
       if not pid.isdigit():
         continue
       try:
-        with open(f'/proc/{pid}/cmdline', 'r') as f:
-          cmdline = f.read()
-        cmdline = shlex.join(cmdline.split('\0')[:-1])
-        if any((m in cmdline for m in matches)):
-          results[pid] = cmdline
-      except FileNotFoundError:
+        raw = read_proc_file(f'/proc/{pid}/cmdline')
+        if not bpattern.search(raw.replace(b'\0', b' ')):
+          continue
+        args = raw.decode(errors = 'surrogateescape').split('\0')[:-1]
+        results[int(pid)] = (shlex.join(args),
+                             get_proc_stat(pid) if columns else None)
+      except (FileNotFoundError, ProcessLookupError):
         pass
   except FileNotFoundError:
     if not (powershell := shutil.which('powershell')):
@@ -46,14 +217,20 @@ def ps(named_args):
       powershell, '-c',
       'Get-CimInstance -ClassName Win32_Process | ConvertTo-Json'
     )))
+    spattern = re.compile(pattern)
     for proc in procs:
       cmdline = proc['CommandLine']
-      if any((m in cmdline for m in matches)):
+      if spattern.search(cmdline or ''):
           pid = proc['ProcessId']
-          results[pid] = cmdline
+          results[pid] = (cmdline, None)
+  boot_time = get_boot_time() if 'start' in columns else 0
   for pid in sorted(results.keys()):
+    cmdline, stat = results[pid]
     print(f'PID: {pid}')
-    print(f'CMDLINE: {results[pid]}')
+    print(f'CMDLINE: {cmdline}')
+    if stat:
+      for line in format_proc_columns(stat, columns, boot_time):
+        print(line)
     print('')
 
 def try_find_dbus_sessions(named_args):
@@ -127,49 +304,217 @@ def get_container_name(name, named_args):
     raise ValueError(f'Invalid prefix: {name}')
   return prefix+name
 
+def get_container_names(names, named_args):
+  names = [get_container_name(name, named_args) for name in names]
+  if 'all' in named_args:
+    prefix = get_container_name('', named_args)
+    names += [i for i in list_containers(named_args)
+              if i.startswith(prefix) and i not in names]
+  if not names:
+    raise ValueError('No containers given: pass names and/or --all')
+  return names
+
 def get_container_engine(named_args):
-  for engine in ([named_args.get('engine')] + DEFAULT_CONTAINER_ENGINES):
+  for engine in (named_args.get('engine'), *DEFAULT_CONTAINER_ENGINES):
     if engine and (engine := shutil.which(engine)):
       return engine
   raise ValueError(f'No container engine found: install Podman or Docker, ' +
                    'specify an engine with --engine and/or check args')
 
-def run_container_cmd(cmd, named_args, stdin = None):
+def get_container_cmd_args(cmd, named_args):
   cmd_args = [get_container_engine(named_args), *cmd]
   if user := named_args.get('user'):
     cmd_args = ['sudo', '-u', user, *cmd_args]
-  return subprocess.check_call(cmd_args, stdin = stdin)
+  return cmd_args
+
+def run_container_cmd(cmd, named_args, stdin = None):
+  return subprocess.check_call(get_container_cmd_args(cmd, named_args),
+                               stdin = stdin)
+
+def get_container_api_socket(named_args):
+  backend = named_args.get('backend', DEFAULT_CONTAINER_BACKEND)
+  if backend == 'cli':
+    return None
+  if socket_path := named_args.get('socket'):
+    candidates = [socket_path]
+  else:
+    user = named_args.get('user')
+    if not user:
+      uid = os.getuid()
+    elif user.startswith('#'):
+      uid = int(user[1:])
+    else:
+      import pwd
+      uid = pwd.getpwnam(user).pw_uid
+    engines = [named_args['engine']] if named_args.get('engine') else \
+              DEFAULT_CONTAINER_ENGINES
+    candidates = [CONTAINER_API_SOCKETS[os.path.basename(engine)]
+                  [0 if user or uid != 0 else 1].format(uid = uid)
+                  for engine in engines
+                  if os.path.basename(engine) in CONTAINER_API_SOCKETS]
+  import socket
+  for path in candidates:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+      try:
+        sock.connect(path)
+        return path
+      except OSError:
+        continue
+  if backend == 'api':
+    raise RuntimeError('No container API socket found: check that ' +
+                       'podman.socket is running or specify --socket')
+  return None
+
+def open_container_api(path):
+  import http.client, socket
+  conn = http.client.HTTPConnection('localhost',
+                                    timeout = DEFAULT_CONTAINER_API_TIMEOUT)
+  def connect():
+    conn.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.sock.settimeout(conn.timeout)
+    conn.sock.connect(path)
+  conn.connect = connect
+  return conn
+
+def container_api_request(conn, method, path, body = None):
+  import json
+  headers = {}
+  if body is not None:
+    body = json.dumps(body).encode()
+    headers['Content-Type'] = 'application/json'
+  for attempt in range(2):
+    reused = conn.sock is not None
+    try:
+      conn.request(method, path, body = body, headers = headers)
+      response = conn.getresponse()
+      return response.status, response.read()
+    except ConnectionError:
+      # the engine may have dropped the idle keep-alive connection
+      conn.close()
+      if not reused or attempt > 0:
+        raise
+
+def get_container_api_error(status, data):
+  if status < 400:
+    return None
+  import json
+  try:
+    return json.loads(data).get('message') or str(status)
+  except (ValueError, AttributeError):
+    return f'{status} {data.decode(errors = "replace").strip()}'
+
+def check_container_api(status, data, what):
+  if error := get_container_api_error(status, data):
+    raise RuntimeError(f'{what}: {error}')
+
+def pull_container_image(conn, image):
+  import json, urllib.parse
+  query = {'fromImage': image}
+  if '@' not in image and ':' not in image.rsplit('/', 1)[-1]:
+    # without a tag the API pulls every tag of the image
+    query['tag'] = 'latest'
+  status, data = container_api_request(
+    conn, 'POST', '/images/create?' + urllib.parse.urlencode(query))
+  check_container_api(status, data, f'Pull {image}')
+  for line in data.splitlines():
+    if line.strip() and (error := json.loads(line).get('error')):
+      raise RuntimeError(f'Pull {image}: {error}')
+
+def list_containers(named_args):
+  if socket_path := get_container_api_socket(named_args):
+    import json
+    conn = open_container_api(socket_path)
+    try:
+      status, data = container_api_request(conn, 'GET',
+                                           '/containers/json?all=true')
+    finally:
+      conn.close()
+    check_container_api(status, data, 'List containers')
+    return [name.lstrip('/') for container in json.loads(data)
+            for name in container.get('Names') or ()]
+  return subprocess.check_output(
+    get_container_cmd_args(['ps', '-a', '--format', '{{.Names}}'],
+                           named_args)
+  ).decode().split()
+
+def run_container_batch(action, names, named_args):
+  socket_path = get_container_api_socket(named_args)
+  if not socket_path:
+    return run_container_cmd([action, *names], named_args)
+  import threading
+  from concurrent.futures import ThreadPoolExecutor
+  method, path = CONTAINER_API_ACTIONS[action]
+  local = threading.local()
+  conns = []
+  def run(name):
+    if not hasattr(local, 'conn'):
+      local.conn = open_container_api(socket_path)
+      conns.append(local.conn)
+    status, data = container_api_request(local.conn, method, path.format(name))
+    # 304 means the container was already started or stopped
+    return get_container_api_error(status, data)
+  workers = int(named_args.get('workers', DEFAULT_CONTAINER_API_WORKERS))
+  try:
+    with ThreadPoolExecutor(max_workers = max(1, min(workers,
+                                                     len(names)))) as pool:
+      errors = [(name, error) for name, error in zip(names,
+                                                     pool.map(run, names))
+                if error]
+  finally:
+    for conn in conns:
+      conn.close()
+  for name, error in errors:
+    print(f'{name}: {error}', file = sys.stderr)
+  if errors:
+    raise RuntimeError(f'Failed to {action} {len(errors)} of ' +
+                       f'{len(names)} container(s)')
 
 def create_container(name, image, cmd, named_args):
   name = get_container_name(name, named_args)
-  run_container_cmd(['container', 'create', '-it', 
-                     '--name', name, image] + cmd,
-                    named_args)
+  socket_path = get_container_api_socket(named_args)
+  if not socket_path:
+    return run_container_cmd(['container', 'create', '-it', 
+                              '--name', name, image] + cmd,
+                             named_args)
+  body = {'Image': image, 'Tty': True, 'OpenStdin': True}
+  if cmd:
+    body['Cmd'] = cmd
+  conn = open_container_api(socket_path)
+  try:
+    path = f'/containers/create?name={name}'
+    status, data = container_api_request(conn, 'POST', path, body = body)
+    if status == 404:
+      # unlike the CLI, the API doesn't pull missing images on create
+      pull_container_image(conn, image)
+      status, data = container_api_request(conn, 'POST', path, body = body)
+    check_container_api(status, data, f'Create {name}')
+  finally:
+    conn.close()
 
-def delete_container(name, named_args):
-  name = get_container_name(name, named_args)
-  run_container_cmd(['rm', name], named_args)
+def delete_container(names, named_args):
+  run_container_batch('rm', get_container_names(names, named_args),
+                      named_args)
 
-def start_container(name, named_args):
-  name = get_container_name(name, named_args)
-  run_container_cmd(['start', name], named_args)
+def start_container(names, named_args):
+  run_container_batch('start', get_container_names(names, named_args),
+                      named_args)
 
-def stop_container(name, named_args):
-  name = get_container_name(name, named_args)
-  run_container_cmd(['stop', name], named_args)
+def stop_container(names, named_args):
+  run_container_batch('stop', get_container_names(names, named_args),
+                      named_args)
 
 def exec_in_container(name, named_args):
   name = get_container_name(name, named_args)
   shell = named_args.get('shell', DEFAULT_CONTAINER_SHELL)
-  stdin = sys.stdin.buffer.read()
-  run_container_cmd(['exec', '-i', name, shell], named_args, stdin = stdin)
+  # the engine inherits our stdin and reads it directly, nothing is buffered
+  run_container_cmd(['exec', '-i', name, shell], named_args,
+                    stdin = sys.stdin.fileno())
 
 def run_script_in_container(name, script_path, named_args):
   name = get_container_name(name, named_args)
   shell = named_args.get('shell', DEFAULT_CONTAINER_SHELL)
   with open(script_path, 'rb') as f:
-    contents = f.read()
-  run_container_cmd(['exec', '-i', name, shell], named_args, stdin = contents)
+    run_container_cmd(['exec', '-i', name, shell], named_args, stdin = f)
 
 def _try_runuser(user, env, cmd):
   if getattr(os, 'getuid', str)() != 0:
@@ -195,21 +540,12 @@ def _try_runuser(user, env, cmd):
                             cmd)
   return p
 
-def run_as_user(cmd, named_args):
+def discover_session_env(named_args):
   dbus_sessions = try_find_dbus_sessions(named_args)
-  if len(dbus_sessions) < 0:
+  if not dbus_sessions:
     raise RuntimeError('No DBUS sessions found')
   uid, addr = dbus_sessions[0]
   env = {'DBUS_SESSION_BUS_ADDRESS': addr}
-  sudo_user = named_args.get('sudo_user')
-  use_sudo = True
-  if sudo_user:
-    user = sudo_user if type(sudo_user) is str else sudo_user[0]
-    import getpass
-    use_sudo = (getpass.getuser() != user)
-  else:
-    user = f'#{uid}'
-    use_sudo = (os.getuid() != uid)
   for rt_root in XDG_RUNTIME_SEARCH_PATHS:
     rt_dir = os.path.join(rt_root, str(uid))
     if os.path.isdir(rt_dir):
@@ -236,6 +572,80 @@ def run_as_user(cmd, named_args):
         env['WAYLAND_DISPLAY'] = w
   except KeyError:
     pass
+  return uid, env
+
+def get_session_env_cache_path(named_args):
+  if 'env_cache' in named_args:
+    return named_args['env_cache'] or None
+  if os.getuid() == 0:
+    return os.path.join('/run/mclite', SESSION_ENV_CACHE_NAME)
+  runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or \
+                os.path.expanduser('~/.cache')
+  return os.path.join(runtime_dir, 'mclite', SESSION_ENV_CACHE_NAME)
+
+def get_session_env_stamps(uid, env):
+  # anything a login or logout adds, removes or replaces changes one of these
+  import tempfile
+  paths = [*DBUS_SEARCH_PATHS,
+           os.path.join(tempfile.gettempdir(), '.X11-unix'),
+           *(os.path.join(i, str(uid)) for i in XDG_RUNTIME_SEARCH_PATHS)]
+  addr = env['DBUS_SESSION_BUS_ADDRESS']
+  if addr.startswith('unix:path='):
+    paths.append(addr[10:])
+  if 'XAUTHORITY' in env:
+    paths.append(env['XAUTHORITY'])
+  stamps = []
+  for path in paths:
+    try:
+      st = os.stat(path)
+      stamps.append([path, st.st_ino, st.st_mtime_ns])
+    except FileNotFoundError:
+      stamps.append([path, None, None])
+  return stamps
+
+def get_session_env(named_args):
+  import json
+  cache_path = get_session_env_cache_path(named_args)
+  key = json.dumps([named_args.get('user'), named_args.get('dbus_user'),
+                    os.environ.get('DBUS_SESSION_BUS_ADDRESS')])
+  cache = {}
+  if cache_path:
+    try:
+      with open(cache_path, 'r') as f:
+        cache = json.load(f)
+      entry = cache[key]
+      uid, env = entry['uid'], entry['env']
+      if entry['stamps'] == get_session_env_stamps(uid, env):
+        return uid, env
+    except (OSError, ValueError, KeyError, TypeError):
+      pass
+  uid, env = discover_session_env(named_args)
+  if cache_path:
+    cache = cache if type(cache) is dict else {}
+    cache[key] = {'uid': uid, 'env': env,
+                  'stamps': get_session_env_stamps(uid, env)}
+    try:
+      os.makedirs(os.path.dirname(cache_path), mode = 0o700, exist_ok = True)
+      tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+      with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                        0o600), 'w') as f:
+        json.dump(cache, f)
+      os.replace(tmp_path, cache_path)
+    except OSError:
+      pass
+  return uid, env
+
+def run_as_user(cmd, named_args):
+  uid, env = get_session_env(named_args)
+  sudo_user = named_args.get('sudo_user')
+  use_sudo = True
+  if sudo_user:
+    user = sudo_user if type(sudo_user) is str else sudo_user[0]
+    import getpass
+    use_sudo = (getpass.getuser() != user)
+  else:
+    user = f'#{uid}'
+    use_sudo = (os.getuid() != uid)
   if use_sudo:
     if not _try_runuser(user, env, cmd):
       subprocess.check_call(['sudo'] +
@@ -263,7 +673,44 @@ def show_sessions(user = None):
           ('loginctl', 'show-session', str(session.get('session')))
     ).decode().strip())
 
-def login_and_lock(user, session, conf):
+def open_inotify(path, mask):
+  try:
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno = True)
+    fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+  except (OSError, AttributeError):
+    return None
+  if fd < 0:
+    return None
+  if libc.inotify_add_watch(fd, os.fsencode(path), mask) < 0:
+    os.close(fd)
+    return None
+  return fd
+
+def wait_for_session(user, timeout, path = LOGIND_SESSIONS_PATH):
+  import select, time
+  deadline = time.monotonic() + timeout
+  # logind writes a file per session here, only recheck when one changes
+  fd = open_inotify(path, IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE)
+  try:
+    while True:
+      if len(get_sessions(user = user)) > 0:
+        return True
+      if (remaining := deadline - time.monotonic()) <= 0:
+        return False
+      if fd is None:
+        time.sleep(min(SESSION_POLL_INTERVAL, remaining))
+      elif select.select((fd,), (), (), remaining)[0]:
+        try:
+          while os.read(fd, 65536):
+            pass
+        except BlockingIOError:
+          pass
+  finally:
+    if fd is not None:
+      os.close(fd)
+
+def login_and_lock(user, session, conf, timeout = DEFAULT_LOGIN_TIMEOUT):
   if len(get_sessions(user = user)) > 0:
     subprocess.check_call(('loginctl', 'lock-sessions'))
     return
@@ -274,7 +721,7 @@ def login_and_lock(user, session, conf):
   )
   with open(conf, 'r') as f:
     txt = f.read()
-  import re, tempfile, time, stat
+  import re, tempfile
   for k,v in entries:
     txt = re.sub('\n'+k+'=.*', '\n'+k+'='+v, txt)
   tf = tempfile.NamedTemporaryFile(mode = 'w', prefix = 'sddm_conf_')
@@ -282,13 +729,13 @@ def login_and_lock(user, session, conf):
   tf.flush()
   os.chmod(tf.fileno(), os.stat(conf).st_mode)
   subprocess.check_call(('mount', '--bind', tf.name, conf))
-  subprocess.check_call(('systemctl', 'restart', 'display-manager.service'))
-  while True:
-    time.sleep(0.1)
-    if len(get_sessions(user = user)) > 0:
-      subprocess.check_call(('umount', conf))
-      tf.close()
-      break
+  try:
+    subprocess.check_call(('systemctl', 'restart', 'display-manager.service'))
+    if not wait_for_session(user, timeout):
+      raise TimeoutError(f'No session for {user} after {timeout}s')
+  finally:
+    subprocess.check_call(('umount', conf))
+    tf.close()
   subprocess.check_call(('loginctl', 'lock-sessions'))
 
 def generate_key(key_length = DEFAULT_KEY_LENGTH, b85 = True):
@@ -323,29 +770,86 @@ def generate_config(key_length = DEFAULT_KEY_LENGTH,
   ]
   return ''.join((line + '\n' for line in out))
 
-def main():
+def parse_args(argv):
   positional_args = []
   named_args = {}
   current_name = None
   hit_end_of_named_args = False
-  for arg in sys.argv[1:]:
+  for arg in argv:
     if arg == '--' and not hit_end_of_named_args:
       hit_end_of_named_args = True
       current_name = None
     elif arg[:2] == '--' and not hit_end_of_named_args:
       current_name = arg[2:]
+      # flags given without a value are kept so they can be tested with `in`
+      named_args.setdefault(current_name, '')
     elif current_name is None:
       positional_args.append(arg)
     else:
-      if type(named_args.get(current_name)) is str:
+      if type(named_args[current_name]) is str and named_args[current_name]:
         named_args[current_name] = [named_args[current_name], arg]
       else:
         named_args[current_name] = arg
+  return positional_args, named_args
+
+def worker(fd):
+  import socket, json, traceback, resource
+  def get_usage():
+    usage = [resource.getrusage(resource.RUSAGE_SELF),
+             resource.getrusage(resource.RUSAGE_CHILDREN)]
+    return {
+      'user_cpu': sum(i.ru_utime for i in usage),
+      'system_cpu': sum(i.ru_stime for i in usage),
+      'max_rss': max(i.ru_maxrss for i in usage),
+      'blocks_in': sum(i.ru_inblock for i in usage),
+      'blocks_out': sum(i.ru_oublock for i in usage),
+      'voluntary_switches': sum(i.ru_nvcsw for i in usage),
+      'involuntary_switches': sum(i.ru_nivcsw for i in usage),
+    }
+  sock = socket.socket(fileno = fd)
+  devnull = os.open(os.devnull, os.O_RDWR)
+  while True:
+    data, fds, _, _ = socket.recv_fds(sock, 1024*1024, 2)
+    if not data:
+      return
+    stdin_fd, stdout_fd = fds
+    os.dup2(stdin_fd, 0)
+    os.dup2(stdout_fd, 1)
+    os.dup2(stdout_fd, 2)
+    os.close(stdin_fd)
+    os.close(stdout_fd)
+    before = get_usage()
+    rc = 0
+    try:
+      run_command(*parse_args(json.loads(data)['argv']))
+    except SystemExit as e:
+      if type(e.code) is int or e.code is None:
+        rc = e.code or 0
+      else:
+        print(e.code, file = sys.stderr)
+        rc = 1
+    except BaseException:
+      traceback.print_exc()
+      rc = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    # drop our end of the pipes so the server sees all output and EOF
+    for i in (0, 1, 2):
+      os.dup2(devnull, i)
+    after = get_usage()
+    usage = {k: v - before[k] for k, v in after.items() if k != 'max_rss'}
+    # ru_maxrss is a peak over the worker's whole life, not this command's
+    usage['worker_max_rss'] = after['max_rss']
+    sock.send(json.dumps({'rc': rc, 'rusage': usage}).encode())
+
+def run_command(positional_args, named_args):
   if not positional_args:
     raise ValueError('No command given')
   command = positional_args[0]
   if command == 'ps':
     return ps(named_args)
+  elif command == 'top':
+    return top(named_args)
   elif command == 'kde_logout':
     return kde_logout(named_args)
   elif command == 'create_container':
@@ -354,14 +858,14 @@ def main():
     cmd = positional_args[3:]
     return create_container(name, image, cmd, named_args)
   elif command == 'delete_container':
-    name = positional_args[1]
-    return delete_container(name, named_args)
+    names = positional_args[1:]
+    return delete_container(names, named_args)
   elif command == 'start_container':
-    name = positional_args[1]
-    return start_container(name, named_args)
+    names = positional_args[1:]
+    return start_container(names, named_args)
   elif command == 'stop_container':
-    name = positional_args[1]
-    return stop_container(name, named_args)
+    names = positional_args[1:]
+    return stop_container(names, named_args)
   elif command == 'exec_in_container':
     name = positional_args[1]
     return exec_in_container(name, named_args)
@@ -378,7 +882,8 @@ def main():
     user = positional_args[1]
     session = positional_args[2]
     conf = positional_args[3]
-    return login_and_lock(user, session, conf)
+    timeout = float(named_args.get('timeout', DEFAULT_LOGIN_TIMEOUT))
+    return login_and_lock(user, session, conf, timeout = timeout)
   elif command == 'generate_key':
     kl = int(named_args.get('length', DEFAULT_KEY_LENGTH))
     return print(generate_key(key_length = kl))
@@ -390,10 +895,15 @@ def main():
     il = int(named_args.get('id_length', DEFAULT_ID_LENGTH))
     name = named_args.get('name')
     return print(generate_config(key_length = kl, id_length = il, name = name))
+  elif command == 'worker':
+    return worker(int(named_args['fd']))
   elif command == 'help':
     return print(HELP_TEXT)
   else:
     raise ValueError(f'Invalid command: {command}\nRun `help` for help')
 
+def main():
+  return run_command(*parse_args(sys.argv[1:]))
+
 if __name__ == '__main__':
   main()
@@ -1,23 +1,163 @@
 #!/usr/bin/env python3
 
+IN_PROCESS_PREFIX = 'python:'
+RECENT_WAKE_WINDOW = 15*60
+IDLE_GRACE = 24*60*60
+IDLE_STRETCH = 7*24*60*60
+ACTIVITY_HALF_LIFE = 14*24*60*60
+
+def load_schedule(path):
+  import json, time
+  try:
+    with open(path, 'r') as f:
+      return json.load(f)
+  except (TypeError, OSError, ValueError):
+    now = time.time()
+    return {'hours': [0]*24, 'last_wake': now, 'updated': now}
+
+def save_schedule(path, schedule):
+  import os, json
+  if not path:
+    return
+  try:
+    with open(path + '.tmp', 'w') as f:
+      json.dump(schedule, f)
+    os.replace(path + '.tmp', path)
+  except OSError:
+    pass
+
+def record_wake(schedule, now):
+  import time
+  # Older wakes count for less so the learned hours follow changing habits
+  decay = 0.5 ** ((now - schedule['updated']) / ACTIVITY_HALF_LIFE)
+  schedule['hours'] = [i * decay for i in schedule['hours']]
+  schedule['hours'][time.localtime(now).tm_hour] += 1
+  schedule['updated'] = schedule['last_wake'] = now
+
+def get_interval(schedule, now, delay, min_delay, max_delay):
+  import time
+  idle = now - schedule['last_wake']
+  if idle < RECENT_WAKE_WINDOW:
+    return min_delay
+  hours = schedule['hours']
+  if peak := max(hours):
+    hour = time.localtime(now).tm_hour
+    activity = max(hours[hour], hours[(hour + 1) % 24]) / peak
+    interval = max_delay - (max_delay - min_delay) * activity
+  else:
+    interval = delay
+  stretch = min(max(idle - IDLE_GRACE, 0) / IDLE_STRETCH, 1)
+  interval += (max_delay - interval) * stretch
+  return min(max(interval, min_delay), max_delay)
+
+def start_in_process(path, url, verify, conn):
+  import sys, os
+  if hasattr(os, 'fork'):
+    if pid := os.fork():
+      conn.close()
+      os.waitpid(pid, 0)
+      return
+    if os.fork():
+      os._exit(0)
+    os.setsid()
+    null = os.open(os.devnull, os.O_RDWR)
+    for fd in range(3):
+      os.dup2(null, fd)
+  try:
+    import importlib.util, importlib.machinery
+    path = os.path.abspath(path)
+    sys.path.insert(0, os.path.dirname(path))
+    loader = importlib.machinery.SourceFileLoader('server', path)
+    spec = importlib.util.spec_from_loader('server', loader)
+    server = importlib.util.module_from_spec(spec)
+    loader.exec_module(server)
+    server.adopt_connection(url, verify, conn)
+    server.daemon_main()
+  finally:
+    if hasattr(os, 'fork'):
+      os._exit(0)
+
 def main():
-  import sys, os, time, ssl, urllib.request
+  import sys, os, time, ssl, shlex, subprocess, http.client, urllib.parse
+  delay = float(sys.argv[1])
+  timeout = float(sys.argv[2])
+  url = urllib.parse.urlsplit(sys.argv[4])
+  path = (url.path or '/') + ('?' + url.query if url.query else '')
+  if url.scheme == 'https':
+    context = ssl.create_default_context(cafile = sys.argv[3])
+    connect = lambda: http.client.HTTPSConnection(url.hostname, url.port,
+                                                  timeout = timeout,
+                                                  context = context)
+  else:
+    connect = lambda: http.client.HTTPConnection(url.hostname, url.port,
+                                                 timeout = timeout)
+
+  def run(cmd):
+    try:
+      subprocess.call(shlex.split(cmd, posix = os.name != 'nt'))
+    except OSError:
+      pass
+
+  def poll(conn):
+    conn.request('GET', path)
+    resp = conn.getresponse()
+    if resp.status >= 400:
+      raise http.client.HTTPException(f'HTTP {resp.status} {resp.reason}')
+    # Only the number of non-whitespace bytes matters, stop once it's over 2
+    count = 0
+    while count <= 2 and (chunk := resp.read(64)):
+      count += len(chunk.translate(None, b' \t\r\n'))
+    if count > 2 and handoff and not resp.will_close:
+      resp.read()
+      return True, False
+    return count > 2, resp.will_close or count > 2
+
+  # Servers given as python:PATH are run in a forked copy of this process
+  # which reuses its connection to the bus instead of opening a new one
+  handoff = sys.argv[5].startswith(IN_PROCESS_PREFIX)
+  # With a minimum and maximum interval, polls are more frequent after
+  # recent wakes and during the hours wakes usually happen
+  adaptive = len(sys.argv) > 8
+  if adaptive:
+    min_delay = float(sys.argv[7])
+    max_delay = float(sys.argv[8])
+    schedule_path = sys.argv[9] if len(sys.argv) > 9 else None
+    schedule = load_schedule(schedule_path)
+  conn = None
   while True:
-    time.sleep(float(sys.argv[1]))
+    if adaptive:
+      time.sleep(get_interval(schedule, time.time(), delay,
+                              min_delay, max_delay))
+    else:
+      time.sleep(delay)
     try:
-      if len(urllib.request.urlopen(urllib.request.Request(sys.argv[4]),
-                                    context = ssl.create_default_context(
-                                      cafile = sys.argv[3]
-                                    ),
-                                    timeout = float(sys.argv[2]))
-                                      .read()
-                                      .replace(b' ', b'')
-                                      .replace(b'\t', b'')
-                                      .replace(b'\r', b'')
-                                      .replace(b'\n', b'')) > 2:
-        os.system(sys.argv[5])
-    except:
-      os.system(sys.argv[6])
+      try:
+        reused = conn is not None
+        conn = conn or connect()
+        woken, close = poll(conn)
+      except ConnectionError:
+        if not reused:
+          raise
+        conn.close()
+        conn = connect()
+        woken, close = poll(conn)
+      if close:
+        conn.close()
+        conn = None
+      if woken and adaptive:
+        record_wake(schedule, time.time())
+        save_schedule(schedule_path, schedule)
+      if woken and handoff and conn:
+        start_in_process(sys.argv[5][len(IN_PROCESS_PREFIX):],
+                         sys.argv[4], sys.argv[3], conn)
+        conn = None
+      elif woken:
+        run(sys.argv[5].removeprefix(IN_PROCESS_PREFIX))
+    except Exception:
+      if conn:
+        conn.close()
+        conn = None
+      run(sys.argv[6])
 
 if __name__ == '__main__':
   main()
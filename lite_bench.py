@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import sys, os, time, ssl, shlex, shutil, signal, subprocess, threading
+import http.server
+
+DEFAULT_DURATION = 600
+DEFAULT_DELAY = 0.1
+DEFAULT_TIMEOUT = 30
+DEFAULT_WAKE_EVERY = 100
+DEFAULT_SAMPLE_INTERVAL = 1
+
+class BenchBusHandler(http.server.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, *args):
+    pass
+
+  def setup(self):
+    super().setup()
+    with self.server.lock:
+      self.server.counts['connections'] += 1
+
+  def do_GET(self):
+    with self.server.lock:
+      self.server.counts['polls'] += 1
+      wake = (self.server.counts['polls'] % self.server.wake_every) == 0
+      if wake:
+        self.server.counts['wakes'] += 1
+    body = b'[{"payload": "wake"}]' if wake else b'[]'
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+def start_bus(wake_every, cert, key):
+  bus = http.server.ThreadingHTTPServer(('127.0.0.1', 0), BenchBusHandler)
+  bus.daemon_threads = True
+  bus.lock = threading.Lock()
+  bus.counts = {'connections': 0, 'polls': 0, 'wakes': 0}
+  bus.wake_every = wake_every
+  if cert:
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert, key)
+    bus.socket = context.wrap_socket(bus.socket, server_side = True)
+  threading.Thread(target = bus.serve_forever, daemon = True).start()
+  return bus
+
+def read_proc(pid):
+  with open(f'/proc/{pid}/status', 'r') as f:
+    rss = next((int(line.split()[1]) for line in f
+                if line.startswith('VmRSS:')), 0)
+  with open(f'/proc/{pid}/stat', 'r') as f:
+    fields = f.read().rsplit(')', 1)[1].split()
+  tick = os.sysconf('SC_CLK_TCK')
+  cpu = (int(fields[11]) + int(fields[12])) / tick
+  children_cpu = (int(fields[13]) + int(fields[14])) / tick
+  return rss, cpu, children_cpu
+
+def bench(script, duration, delay, wake_every, cert, key):
+  bus = start_bus(wake_every, cert, key)
+  scheme = 'https' if cert else 'http'
+  url = f'{scheme}://localhost:{bus.server_address[1]}/?name=bench'
+  noop = shlex.join([shutil.which('true') or sys.executable] +
+                    ([] if shutil.which('true') else ['-c', 'pass']))
+  proc = subprocess.Popen((sys.executable, script, str(delay),
+                           str(DEFAULT_TIMEOUT), cert or '', url, noop, noop))
+  samples = []
+  cpu = children_cpu = 0
+  deadline = time.monotonic() + duration
+  try:
+    while time.monotonic() < deadline and proc.poll() is None:
+      time.sleep(DEFAULT_SAMPLE_INTERVAL)
+      rss, cpu, children_cpu = read_proc(proc.pid)
+      samples.append(rss)
+  finally:
+    proc.send_signal(signal.SIGTERM)
+    proc.wait()
+    bus.shutdown()
+  counts = bus.counts
+  polls = max(counts['polls'], 1)
+  print(f'{script}:')
+  print(f"  {counts['polls']} polls over {counts['connections']} " +
+        f"connection(s), {counts['wakes']} wakes")
+  if samples:
+    print(f'  RSS: {sum(samples) // len(samples)} KiB average, ' +
+          f'{max(samples)} KiB max')
+  print(f'  CPU: {cpu:.2f}s self, {children_cpu:.2f}s children, ' +
+        f'{1000 * (cpu + children_cpu) / polls:.3f} ms per poll')
+  print('')
+
+def main():
+  scripts = []
+  duration = DEFAULT_DURATION
+  delay = DEFAULT_DELAY
+  wake_every = DEFAULT_WAKE_EVERY
+  cert = None
+  key = None
+  it = iter(sys.argv[1:])
+  for arg in it:
+    if arg == '--duration':
+      duration = float(next(it))
+    elif arg == '--delay':
+      delay = float(next(it))
+    elif arg == '--wake-every':
+      wake_every = int(next(it))
+    elif arg == '--cert':
+      cert = next(it)
+    elif arg == '--key':
+      key = next(it)
+    else:
+      scripts.append(arg)
+  if not scripts:
+    print(f'usage: {sys.argv[0]} [--duration SECONDS] [--delay SECONDS] ' +
+          '[--wake-every POLLS] [--cert CERT --key KEY] SCRIPT...')
+    return 1
+  for script in scripts:
+    bench(script, duration, delay, wake_every, cert, key)
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -1,5 +1,5 @@
-import os, base64, hashlib, tempfile, getpass, time, functools
-import ssl, urllib.request, urllib.parse, json
+import os, base64, hashlib, tempfile, getpass, time, functools, threading
+import ssl, urllib.request, urllib.parse, urllib.error, http.client, json, io
 
 try:
   import cryptography.hazmat.primitives.ciphers
@@ -14,6 +14,8 @@ DEFAULT_WATCHDOG_TIMEOUT = 300
 DEFAULT_CONFIG_NAME = 'config.toml'
 DEFAULT_CONFIG_ENV_VAR_NAME = 'MISSIONCONTROLLITELIBCONFIG'
 DEFAULT_CERT_NAME = 'cert.pem'
+DEFAULT_POOL_MAX_IDLE = 4
+STATS_COMMAND_NAME = '__stats__'
 DEFAULT_NAMESPACES = ('mclite', 'missioncontrollite', 'mission-control-lite')
 DEFAULT_CONFIG_DIRS = (
   lambda i : os.path.join(
@@ -43,7 +45,7 @@ def get_config_and_config_path(**kwargs):
   if var := kwargs.get('config_env_var_name', DEFAULT_CONFIG_ENV_VAR_NAME):
     if path := os.environ.get(var):
       with open(path, 'rb') as f:
-        return tomllib.load(f)
+        return tomllib.load(f), path
   namespace = kwargs.get('namespace')
   namespaces = (namespace,) if namespace else DEFAULT_NAMESPACES
   config_name = kwargs.get('config_name', DEFAULT_CONFIG_NAME)
@@ -51,7 +53,7 @@ def get_config_and_config_path(**kwargs):
   for cpath in config_paths:
     paths = [os.path.join(cpath(i), config_name) for i in namespaces] \
             if callable(cpath) else \
-            [os.path.join(config_dir, config_name)]
+            [os.path.join(cpath, config_name)]
     for path in paths:
       try:
         with open(path, 'rb') as f:
@@ -162,26 +164,112 @@ def encrypt(payload, key):
   epayload = json.dumps(epayload).encode()
   return aes_encrypt(epayload, key)
 
-def request(url, verify = True, data = None):
+@functools.cache
+def get_ssl_context(cafile = None):
+  return ssl.create_default_context(cafile = cafile)
+
+def request(url, verify = True, data = None, timeout = None):
   if verify:
-    cafile = None if verify is True else verify
-    ctx = ssl.create_default_context(cafile = cafile)
+    ctx = get_ssl_context(None if verify is True else verify)
   else:
     ctx = None
   req = urllib.request.Request(url)
   if data is not None:
     data = json.dumps(data).encode()
     req.add_header('Content-Length', len(data))
-  return urllib.request.urlopen(req, context = ctx, data = data)
+  if timeout is None:
+    return urllib.request.urlopen(req, context = ctx, data = data)
+  return urllib.request.urlopen(req, context = ctx, data = data,
+                                timeout = timeout)
+
+class ConnectionPool:
+  def __init__(self, max_idle = DEFAULT_POOL_MAX_IDLE, timeout = None):
+    self.max_idle = max_idle
+    self.timeout = timeout
+    self.lock = threading.Lock()
+    self.idle = {}
+
+  def connect(self, scheme, netloc, verify):
+    if scheme != 'https':
+      return http.client.HTTPConnection(netloc, timeout = self.timeout)
+    if verify:
+      ctx = get_ssl_context(None if verify is True else verify)
+    else:
+      ctx = ssl._create_unverified_context()
+    return http.client.HTTPSConnection(netloc, timeout = self.timeout,
+                                       context = ctx)
+
+  def put(self, url, verify, conn):
+    parts = urllib.parse.urlsplit(url)
+    key = (parts.scheme, parts.netloc, verify)
+    with self.lock:
+      conns = self.idle.setdefault(key, [])
+      if len(conns) < self.max_idle:
+        conns.append(conn)
+        return
+    conn.close()
+
+  def request(self, url, verify = True, data = None, timeout = None):
+    timeout = self.timeout if timeout is None else timeout
+    parts = urllib.parse.urlsplit(url)
+    key = (parts.scheme, parts.netloc, verify)
+    path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+    headers = {}
+    if data is not None:
+      data = json.dumps(data).encode()
+      # Same content type urllib.request sends, as used by request()
+      headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    while True:
+      with self.lock:
+        conn = conns.pop() if (conns := self.idle.get(key)) else None
+      reused = conn is not None
+      if not reused:
+        conn = self.connect(parts.scheme, parts.netloc, verify)
+      conn.timeout = timeout
+      if conn.sock:
+        conn.sock.settimeout(timeout)
+      try:
+        conn.request('GET' if data is None else 'POST', path,
+                     body = data, headers = headers)
+        resp = conn.getresponse()
+        body = resp.read()
+      except (http.client.RemoteDisconnected,
+              ConnectionResetError,
+              BrokenPipeError) as exc:
+        conn.close()
+        if reused:
+          continue
+        raise urllib.error.URLError(exc)
+      except (OSError, http.client.HTTPException) as exc:
+        conn.close()
+        raise urllib.error.URLError(exc)
+      if resp.will_close:
+        conn.close()
+      else:
+        self.put(url, verify, conn)
+      if resp.status >= 400:
+        raise urllib.error.HTTPError(url, resp.status, resp.reason,
+                                     resp.headers, io.BytesIO(body))
+      return body
 
-def send(mcbus_url, recipient, key, payload, verify = True):
+  def close(self):
+    with self.lock:
+      idle, self.idle = self.idle, {}
+    for conns in idle.values():
+      for conn in conns:
+        conn.close()
+
+def send(mcbus_url, recipient, key, payload, verify = True, pool = None):
   if type(key) is str:
     key = base64.b85decode(key)
   pl = {
     'recipient': recipient,
     'payload': base64.b85encode(encrypt(payload, key)).decode(),
   }
-  request(mcbus_url, data = pl, verify = verify)
+  if pool:
+    pool.request(mcbus_url, data = pl, verify = verify)
+  else:
+    request(mcbus_url, data = pl, verify = verify)
 
 def decrypt(payload, key):
   if type(payload) is str:
@@ -195,14 +283,17 @@ def decrypt(payload, key):
     raise ValueError()
   return json.loads(pload)
 
-def receive(mcbus_url, name, verify = True):
+def receive(mcbus_url, name, verify = True, pool = None, timeout = None):
   url = mcbus_url
   if not url.endswith('/'):
     url += '/'
-  resp = request(url + '?name=' + urllib.parse.quote(name),
-                 verify = verify)
+  url += '?name=' + urllib.parse.quote(name)
+  if pool:
+    resp = pool.request(url, verify = verify, timeout = timeout)
+  else:
+    resp = request(url, verify = verify, timeout = timeout).read()
   inbox = []
-  for message in json.loads(resp.read()):
+  for message in json.loads(resp):
     pl = message.get('payload')
     if not pl:
       continue
@@ -230,20 +321,25 @@ def ask(choices, prompt = '> ', error = 'Invalid selection!', delim = ') '):
     print(error)
     print('')
 
+def iwrap(txt, width = 80, indent = '  ', escape_substitute = '`'):
+  # width may be a callable so lines not yet rendered follow terminal resizes
+  pos = 0
+  while pos < len(txt):
+    w = max((width() if callable(width) else width) - len(indent), 1)
+    i = filter(lambda i: i >= 0,
+               (txt.find(b, pos, pos + w) for b in LINE_BOUNDARIES))
+    i = min(i, default = pos + w)
+    yield indent + txt[pos:i].replace(ESC, escape_substitute)
+    pos = (i+2 if txt[i:i+2] in LINE_BOUNDARIES else
+          (i+1 if txt[i:i+1] in LINE_BOUNDARIES else i))
+  if any((txt.endswith(b) for b in LINE_BOUNDARIES)):
+    yield indent
+
 def wrap(txt,
          width = 80,
          indent = '  ',
          boundary = '\n',
          escape_substitute = '`'):
-  result = []
-  w = max(width - len(indent), 1)
-  t = txt.replace(ESC, escape_substitute)
-  while t:
-    i = filter(lambda i: i >= 0, (t.find(b, 0, w) for b in LINE_BOUNDARIES))
-    i = min(i, default = w)
-    result.append(indent + t[:i])
-    t = (t[i+2:] if t[i:i+2] in LINE_BOUNDARIES else
-        (t[i+1:] if t[i:i+1] in LINE_BOUNDARIES else t[i:]))
-  if any((txt.endswith(b) for b in LINE_BOUNDARIES)):
-    result.append(indent)
+  result = list(iwrap(txt, width = width, indent = indent,
+                      escape_substitute = escape_substitute))
   return boundary.join(result) if boundary else result
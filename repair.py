@@ -1,12 +1,30 @@
 #!/usr/bin/env python3
 
 import sys, os, subprocess, shutil, time, tomllib, json, tempfile
+import socket, ssl, threading, urllib.parse, http.client
 sys.dont_write_bytecode = True
 
 DEFAULT_CONSECUTIVE_FAIL_TIMEOUT = 120
 DEFAULT_CONSECUTIVE_FAIL_LIMIT_FOR_NET_RESET = 3
 DEFAULT_CONSECUTIVE_FAIL_LIMIT_FOR_REBOOT = 10
 DEFAULT_COMMAND_TIMEOUT = 600
+DEFAULT_PROBE_TIMEOUT = 3
+DEFAULT_REMOTE_FAIL_LIMIT_FACTOR = 3
+DEFAULT_LOG_MAX_BYTES = 1024*1024
+PROBES = ('link', 'route', 'dns', 'tcp', 'tls', 'http')
+LOCAL_PROBES = ('link', 'route', 'dns')
+GATEWAY_ERRORS = (502, 503, 504)
+# Each failing layer gets the action most likely to fix it. Anything past DNS
+# could be a stuck NIC, a captive portal or a firewall, so resets the network.
+LAYER_ACTIONS = {
+  'link': 'network_reset',
+  'route': 'network_reset',
+  'dns': 'dns_flush',
+  'tcp': 'network_reset',
+  'tls': 'network_reset',
+  'http': 'network_reset',
+  None: 'network_reset',
+}
 
 def run(cmd, timeout):
   proc = subprocess.Popen(cmd,
@@ -19,7 +37,139 @@ def run(cmd, timeout):
     pass
   return proc
 
-def main():
+def flush_dns(command_timeout):
+  if sys.platform in ('win32', 'cygwin'):
+    run(('ipconfig', '/flushdns'), command_timeout)
+  elif resolvectl := shutil.which('resolvectl'):
+    run((resolvectl, 'flush-caches'), command_timeout)
+  elif systemctl := shutil.which('systemctl'):
+    # Only restarts whichever caching resolvers are actually running
+    run((systemctl, 'try-restart', 'systemd-resolved', 'nscd', 'dnsmasq'),
+        command_timeout)
+
+def reset_network(command_timeout):
+  systemctl = shutil.which('systemctl')
+  if systemctl:
+    run((systemctl, 'restart', 'NetworkManager'), command_timeout)
+
+  if sys.platform in ('win32', 'cygwin'):
+    run(('netsh', 'winsock', 'reset'), command_timeout)
+    run(('netsh', 'int', 'ip'), command_timeout)
+    run(('ipconfig', '/release'), command_timeout)
+    run(('ipconfig', '/renew'), command_timeout)
+    run(('ipconfig', '/flushdns'), command_timeout)
+
+def probe_link(url, cert, timeout):
+  try:
+    names = [i for i in os.listdir('/sys/class/net') if i != 'lo']
+  except OSError:
+    return None, 'Not supported'
+  up = []
+  for name in names:
+    try:
+      with open(f'/sys/class/net/{name}/operstate', 'r') as f:
+        # Virtual interfaces e.g. tun and veth often report unknown
+        if f.read().strip() in ('up', 'unknown'):
+          up.append(name)
+    except OSError:
+      pass
+  return bool(up), ', '.join(up) or 'No interfaces up'
+
+def probe_route(url, cert, timeout):
+  try:
+    with open('/proc/net/route', 'r') as f:
+      ipv4 = [line.split() for line in f][1:]
+  except OSError:
+    return None, 'Not supported'
+  try:
+    with open('/proc/net/ipv6_route', 'r') as f:
+      ipv6 = [line.split() for line in f]
+  except OSError:
+    ipv6 = []
+  ifaces = {i[0] for i in ipv4 if i[1] == '00000000'}
+  ifaces |= {i[-1] for i in ipv6
+             if i[0] == 32*'0' and i[1] == '00' and i[-1] != 'lo'}
+  return bool(ifaces), ', '.join(sorted(ifaces)) or 'No default route'
+
+def probe_dns(url, cert, timeout):
+  parts = urllib.parse.urlsplit(url)
+  try:
+    addrs = socket.getaddrinfo(parts.hostname, parts.port or 443,
+                               type = socket.SOCK_STREAM)
+  except socket.gaierror as exc:
+    # Only an unreachable resolver is a local fault, a missing record e.g.
+    # NXDOMAIN is an answer and leaves the TCP probe to fail on the Bus' side
+    if exc.errno == getattr(socket, 'EAI_AGAIN', None):
+      raise
+    return True, f'Resolver answered: {exc.strerror}'
+  return True, ', '.join(sorted({i[4][0] for i in addrs}))
+
+def probe_tcp(url, cert, timeout):
+  parts = urllib.parse.urlsplit(url)
+  port = parts.port or (443 if parts.scheme == 'https' else 80)
+  with socket.create_connection((parts.hostname, port), timeout = timeout):
+    return True, f'{parts.hostname}:{port}'
+
+def probe_tls(url, cert, timeout):
+  parts = urllib.parse.urlsplit(url)
+  if parts.scheme != 'https':
+    return None, 'Not HTTPS'
+  context = ssl.create_default_context(cafile = cert)
+  with socket.create_connection((parts.hostname, parts.port or 443),
+                                timeout = timeout) as sock:
+    with context.wrap_socket(sock, server_hostname = parts.hostname) as tls:
+      return True, tls.version()
+
+def probe_http(url, cert, timeout):
+  parts = urllib.parse.urlsplit(url)
+  if parts.scheme == 'https':
+    conn = http.client.HTTPSConnection(
+      parts.netloc, timeout = timeout,
+      context = ssl.create_default_context(cafile = cert))
+  else:
+    conn = http.client.HTTPConnection(parts.netloc, timeout = timeout)
+  try:
+    # Only the status line is read, the socket timeout bounds the request
+    conn.request('GET', urllib.parse.urlunsplit(('', '', parts.path or '/',
+                                                 parts.query, '')))
+    status = conn.getresponse().status
+  finally:
+    conn.close()
+  # Any answer from the Bus itself, even an error such as 405 or 501, means
+  # it's reachable, only a proxy failing to reach it is a failure
+  return status not in GATEWAY_ERRORS, f'HTTP {status}'
+
+def run_probe(name, url, cert, timeout, results):
+  start = time.monotonic()
+  try:
+    ok, detail = globals()['probe_' + name](url, cert, timeout)
+  except Exception as exc:
+    ok, detail = False, repr(exc)
+  results[name] = {'ok': ok, 'detail': detail,
+                   'time': round(time.monotonic() - start, 3)}
+
+def run_probes(url, cert, timeout):
+  results = {}
+  threads = [threading.Thread(target = run_probe, daemon = True,
+                              args = (name, url, cert, timeout, results))
+             for name in PROBES]
+  for thread in threads:
+    thread.start()
+  # getaddrinfo can't be given a timeout, so the whole stage is bounded
+  deadline = time.monotonic() + timeout
+  for thread in threads:
+    thread.join(max(deadline - time.monotonic(), 0))
+  return {name: results.get(name, {'ok': False, 'detail': 'Timed out',
+                                   'time': timeout})
+          for name in PROBES}
+
+def get_failing_probe(results):
+  for name in PROBES:
+    if results[name]['ok'] is False:
+      return name
+  return None
+
+def load_config():
   try:
     try:
       import missioncontrollitelib
@@ -29,9 +179,138 @@ def main():
         config = tomllib.load(f)
   except OSError:
     config = {}
+  if 'probe_url' not in config:
+    try:
+      import missioncontrollitelib
+      kwargs = {'config_env_var_name': 'MCLITE_SERVER_CONFIG'}
+      server_config = missioncontrollitelib.get_config(**kwargs)
+      config['probe_url'] = server_config['mcbus_url']
+      config.setdefault('probe_cert',
+                        missioncontrollitelib.get_cert_path(**kwargs))
+    except (ModuleNotFoundError, OSError, KeyError):
+      pass
+  return config
+
+def get_log_path(config):
+  if path := config.get('log_path'):
+    return path
+  state_dir = os.environ.get(
+    'XDG_STATE_HOME',
+    os.path.join(os.path.expanduser('~'), '.local', 'state'),
+  )
+  return os.path.join(state_dir, 'mclite', 'repair_log.jsonl')
+
+def append_event(path, event, max_bytes):
+  # One O_APPEND write per event so a crash can at worst truncate the last
+  # line, which read_events skips
+  line = (json.dumps(event) + '\n').encode()
+  try:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+    try:
+      if os.path.getsize(path) + len(line) > max_bytes:
+        os.replace(path, path + '.1')
+    except FileNotFoundError:
+      pass
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+    try:
+      os.write(fd, line)
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+  except OSError:
+    pass
+
+def read_events(path):
+  events = []
+  for p in (path + '.1', path):
+    try:
+      with open(p, 'r') as f:
+        for line in f:
+          try:
+            events.append(json.loads(line))
+          except ValueError:
+            pass
+    except OSError:
+      pass
+  return sorted(events, key = lambda i: i.get('time', 0))
+
+def summarize(events, consecutive_fail_timeout):
+  if not events:
+    print('No events logged')
+    return
+  first, last = events[0]['time'], events[-1]['time']
+  days = max((last - first) / 86400, 1)
+  print(f'Events: {len(events)} from {time.ctime(first)} to {time.ctime(last)}')
+  print(f'Failure rate: {len(events) / days:.2f} per day')
+  layers = {}
+  for event in events:
+    layer = event.get('failing') or 'none'
+    layers[layer] = layers.get(layer, 0) + 1
+  print('Failing layers: ' +
+        ', '.join(f'{k}: {v}' for k,v in sorted(layers.items())))
+
+  # Failures closer together than consecutive_fail_timeout are one outage,
+  # which is assumed to be resolved by the time its last repair finishes
+  outages = [[events[0]]]
+  for event in events[1:]:
+    if event['time'] - outages[-1][-1]['time'] < consecutive_fail_timeout:
+      outages[-1].append(event)
+    else:
+      outages.append([event])
+  recoveries = [i[-1]['time'] + i[-1].get('duration', 0) - i[0]['time']
+                for i in outages]
+  print(f'Outages: {len(outages)}, mean time to recovery: ' +
+        f'{sum(recoveries) / len(recoveries):.1f}s, ' +
+        f'longest: {max(recoveries):.1f}s')
+
+  print('Actions:')
+  actions = {}
+  for outage in outages:
+    end = outage[-1]['time'] + outage[-1].get('duration', 0)
+    for idx, event in enumerate(outage):
+      action = (event.get('actions') or ['none'])[-1]
+      stats = actions.setdefault(action, {'runs': 0, 'resolved': 0,
+                                          'recovery': 0, 'duration': 0})
+      stats['runs'] += 1
+      stats['duration'] += event.get('duration', 0)
+      stats['recovery'] += end - event['time']
+      if idx == len(outage) - 1:
+        stats['resolved'] += 1
+  for action, stats in sorted(actions.items()):
+    runs = stats['runs']
+    print(f"  {action}: {runs} run(s) taking {stats['duration'] / runs:.1f}s " +
+          f"on average, ended the outage {stats['resolved']} time(s) " +
+          f"({stats['resolved'] / runs:.0%}), " +
+          f"{stats['recovery'] / runs:.1f}s on average until recovery")
+
+def print_probes(results):
+  for name, result in results.items():
+    status = {True: 'OK', False: 'FAILED', None: 'SKIPPED'}[result['ok']]
+    print(f"{name}: {status} in {result['time']:.3f}s ({result['detail']})")
+
+def main():
+  config = load_config()
+  probe_timeout = config.get('probe_timeout', DEFAULT_PROBE_TIMEOUT)
+
+  if '--probe' in sys.argv[1:2]:
+    if not (url := sys.argv[2] if len(sys.argv) > 2 else
+                   config.get('probe_url')):
+      print('No Bus URL to probe')
+      return 1
+    cert = sys.argv[3] if len(sys.argv) > 3 else config.get('probe_cert')
+    results = run_probes(url, cert, probe_timeout)
+    print_probes(results)
+    return 1 if get_failing_probe(results) else 0
 
   consecutive_fail_timeout = config.get('consecutive_fail_timeout',
                                          DEFAULT_CONSECUTIVE_FAIL_TIMEOUT)
+  log_path = get_log_path(config)
+
+  if '--summarize' in sys.argv[1:2]:
+    summarize(read_events(sys.argv[2] if len(sys.argv) > 2 else log_path),
+              consecutive_fail_timeout)
+    return 0
+
   net_fail_limit = config.get('consecutive_fail_limit_for_net_reset',
                               DEFAULT_CONSECUTIVE_FAIL_LIMIT_FOR_NET_RESET)
   reboot_fail_limit = config.get('consecutive_fail_limit_for_reboot',
@@ -59,17 +338,50 @@ def main():
   else:
     consecutive_fail_count = 0
 
-  if consecutive_fail_count > net_fail_limit:
-    systemctl = shutil.which('systemctl')
-    if systemctl:
-      run((systemctl, 'restart', 'NetworkManager'), command_timeout)
+  # Escalate as usual when the local network is at fault. When only the Bus
+  # seems unreachable, the fault may still be local e.g. a stuck NIC, a
+  # captive portal or a firewall, so confirm against a known-good host if one
+  # is configured and otherwise escalate only after more failures.
+  local = True
+  probes = failing = reference = None
+  action = LAYER_ACTIONS[None]
+  if url := config.get('probe_url'):
+    probes = run_probes(url, config.get('probe_cert'), probe_timeout)
+    failing = get_failing_probe(probes)
+    local = failing in LOCAL_PROBES
+    action = LAYER_ACTIONS[failing]
+    if not local and failing and \
+       (reference_url := config.get('probe_reference_url')):
+      reference = run_probes(reference_url, None, probe_timeout)
+      reference_failing = get_failing_probe(reference)
+      local = reference_failing is not None
+      # The Bus itself is down when a known-good host is fine, which no
+      # change to the network can fix
+      action = LAYER_ACTIONS[reference_failing] if local else None
+  if not local:
+    factor = config.get('remote_fail_limit_factor',
+                        DEFAULT_REMOTE_FAIL_LIMIT_FACTOR)
+    net_fail_limit *= factor
+    reboot_fail_limit *= factor
 
-    if sys.platform in ('win32', 'cygwin'):
-      run(('netsh', 'winsock', 'reset'), command_timeout)
-      run(('netsh', 'int', 'ip'), command_timeout)
-      run(('ipconfig', '/release'), command_timeout)
-      run(('ipconfig', '/renew'), command_timeout)
-      run(('ipconfig', '/flushdns'), command_timeout)
+  event = {
+    'time': now,
+    'fail_count': fail_count,
+    'consecutive_fail_count': consecutive_fail_count,
+    'probes': probes,
+    'failing': failing,
+    'reference': reference,
+    'local': local,
+    'actions': [],
+  }
+  start = time.monotonic()
+
+  if action and consecutive_fail_count > net_fail_limit:
+    event['actions'].append(action)
+    if action == 'dns_flush':
+      flush_dns(command_timeout)
+    else:
+      reset_network(command_timeout)
 
   state = {
     'last_fail_time': now,
@@ -79,11 +391,18 @@ def main():
   with open(state_path, 'w') as f:
     json.dump(state, f)
 
-  if consecutive_fail_count > reboot_fail_limit:
+  reboot = action and consecutive_fail_count > reboot_fail_limit
+  if reboot:
+    event['actions'].append('reboot')
+  event['duration'] = round(time.monotonic() - start, 3)
+  append_event(log_path, event, config.get('log_max_bytes',
+                                           DEFAULT_LOG_MAX_BYTES))
+
+  if reboot:
     if sys.platform in ('win32', 'cygwin'):
       run(('shutdown', '/r', '/t', '1'), command_timeout)
     else:
       run(('reboot',), command_timeout)
 
 if __name__ == '__main__':
-  main()
+  sys.exit(main())
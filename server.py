@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 
-import sys, os, time, threading, subprocess, shlex, functools, pprint
-import urllib.error
+import sys, os, time, threading, subprocess, shlex, shutil, signal, socket
+import functools, pprint, base64, json, math, itertools, queue
+import urllib.error, urllib.parse
 sys.dont_write_bytecode = True
 
 import missioncontrollitelib
@@ -9,100 +10,708 @@ missioncontrollitelib.DEFAULT_CONFIG_ENV_VAR_NAME = 'MCLITE_SERVER_CONFIG'
 from missioncontrollitelib import *
 
 DEFAULT_COMMAND_OUTPUT_FLUSH_TIMEOUT = 25
+DEFAULT_COMMAND_KILL_TIMEOUT = 10
+DEFAULT_SEND_BATCH_WINDOW = 0.5
+DEFAULT_SEND_BATCH_MAX_MESSAGES = 32
+DEFAULT_SEND_BATCH_MAX_BYTES = 512*1024
+DEFAULT_SEND_RETRIES = 4
+DEFAULT_SEND_RETRY_DELAY = 1
+DEFAULT_MAX_CONCURRENT_COMMANDS = 8
+DEFAULT_RESERVED_INTERACTIVE_SLOTS = 2
+DEFAULT_PRIORITY_AGING_INTERVAL = 60
+DEFAULT_PRIORITY = 'normal'
+DEFAULT_HELPER_WORKERS = 2
+DEFAULT_HELPER_NAMES = ('helper', 'helper.py')
+# Limits that are applied when a process starts and can't be applied to a
+# worker which is reused across commands
+PROCESS_LIMITS = ('rlimit_cpu', 'rlimit_memory', 'nice', 'cgroup',
+                  'systemd_scope', 'ionice_class')
+DEFAULT_BENCH_MESSAGES = 60
+DEFAULT_BENCH_BURST = 20
+DEFAULT_BENCH_BURST_INTERVAL = 2
+DEFAULT_BENCH_SAMPLE_INTERVAL = 0.5
+DEFAULT_BENCH_TIMEOUT = 300
+BENCH_COMMANDS = {
+  'quick': 'pass',
+  'sleep': 'import time; time.sleep(0.5)',
+  'output': 'print(*(80*"x" for _ in range(2000)), sep = "\\n")',
+  'bulk': 'import time; time.sleep(2)',
+}
+PRIORITY_CLASSES = {
+  'emergency': 0,
+  'interactive': 1,
+  'normal': 2,
+  'bulk': 3,
+}
 
-def send(recipient, sections):
+_stdin_streams = {}
+_stdin_streams_lock = threading.Lock()
+_outboxes = {}
+_unsent = {}
+_outboxes_cond = threading.Condition()
+_stats = {
+  'wake_time': time.monotonic(),
+  'messages_handled': 0,
+  'polls': 0,
+  'empty_polls': 0,
+  'decrypt_latency': {},
+  'send_latency': {},
+}
+_jobs = {}
+_job_ids = itertools.count(1)
+_stats_lock = threading.Lock()
+_run_queue = []
+_run_queue_state = {'running': 0}
+_run_queue_lock = threading.Lock()
+_pool = missioncontrollitelib.ConnectionPool()
+_helper_workers = {}
+_helper_workers_lock = threading.Lock()
+
+def record_latency(name, seconds):
+  ms = seconds * 1000
+  bucket = 2**max(math.ceil(math.log2(ms)), 0) if ms > 0 else 1
+  with _stats_lock:
+    hist = _stats[name]
+    hist[bucket] = hist.get(bucket, 0) + 1
+
+def start_job(command_name, priority = DEFAULT_PRIORITY, device = None):
+  job_id = next(_job_ids)
+  with _stats_lock:
+    _jobs[job_id] = {
+      'command_name': command_name,
+      'device': device,
+      'priority': priority,
+      'state': 'queued',
+      'since': time.monotonic(),
+    }
+  return job_id
+
+def update_job(job_id, **kwargs):
+  with _stats_lock:
+    if job := _jobs.get(job_id):
+      job.update(kwargs)
+
+def end_job(job_id):
+  with _stats_lock:
+    _jobs.pop(job_id, None)
+
+def get_rss():
+  try:
+    with open('/proc/self/status', 'r') as f:
+      for line in f:
+        if line.startswith('VmRSS:'):
+          return line.split(':', 1)[1].strip()
+  except FileNotFoundError:
+    pass
+  try:
+    import resource
+    return f'{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss} kB (peak)'
+  except ModuleNotFoundError:
+    return 'unknown'
+
+def format_histogram(hist):
+  if not hist:
+    return 'No samples'
+  lines = []
+  for bucket in sorted(hist.keys()):
+    lines.append(f'<= {bucket} ms: {hist[bucket]}')
+  return '\n'.join(lines)
+
+def get_stats_sections():
+  now = time.monotonic()
+  with _stats_lock:
+    stats = {k: (dict(v) if type(v) is dict else v) for k,v in _stats.items()}
+    jobs = sorted(((k, dict(v)) for k,v in _jobs.items()),
+                  key = lambda i: i[1]['since'])
+  polls = stats['polls']
+  empty_ratio = (stats['empty_polls'] / polls) if polls else 0
+  job_lines = []
+  for job_id, job in jobs:
+    pid = f", PID {job['pid']}" if job.get('pid') else ''
+    job_lines.append(f"#{job_id} {job['device']}/{job['command_name']} " +
+                     f"({job['priority']}): {job['state']} " +
+                     f"for {now - job['since']:.1f}s{pid}")
+  return [
+    {'title': 'UPTIME', 'body': f"{now - stats['wake_time']:.1f}s"},
+    {'title': 'MESSAGES HANDLED', 'body': str(stats['messages_handled'])},
+    {'title': 'POLLS', 'body': f"{polls} ({stats['empty_polls']} empty, " +
+                               f'{empty_ratio:.1%})'},
+    {'title': 'DECRYPT LATENCY',
+     'body': format_histogram(stats['decrypt_latency'])},
+    {'title': 'SEND LATENCY', 'body': format_histogram(stats['send_latency'])},
+    {'title': 'JOBS', 'body': '\n'.join(job_lines) or 'None'},
+    {'title': 'THREADS', 'body': str(threading.active_count())},
+    {'title': 'RSS', 'body': get_rss()},
+    {'title': 'RETURN CODE: 0'},
+  ]
+
+def get_this_devices():
+  devices = get_config()['this_device']
+  return [devices] if type(devices) is str else list(devices)
+
+def send_payload(recipient, payload, device = None):
   bus = get_config()['mcbus_url']
-  this_device = get_config()['this_device']
-  key = get_config()['devices'][this_device]['server_key']
-  missioncontrollitelib.send(bus, recipient, key, {'sections': sections},
-                             verify = get_cert_path())
+  device = device or get_this_devices()[0]
+  key = get_config()['devices'][device]['server_key']
+  start = time.monotonic()
+  missioncontrollitelib.send(bus, recipient, key, payload,
+                             verify = get_cert_path(), pool = _pool)
+  record_latency('send_latency', time.monotonic() - start)
 
-def get_inbox():
-  this_device = get_config()['this_device']
+def send(recipient, sections, device = None, command_name = None):
+  device = device or get_this_devices()[0]
+  payload = {'sections': sections}
+  if command_name is not None:
+    payload['command_name'] = command_name
+  window = get_config().get('send_batch_window', DEFAULT_SEND_BATCH_WINDOW)
+  if not window:
+    return send_payload(recipient, payload, device = device)
+  size = len(json.dumps(sections))
+  with _outboxes_cond:
+    if (outbox := _outboxes.get((device, recipient))) is None:
+      # Messages left over from a flush which gave up go out first
+      outbox = _outboxes[(device, recipient)] = \
+        _unsent.pop((device, recipient), [])
+      threading.Thread(target = flush_outbox,
+                       args = (device, recipient, outbox, window)).start()
+    outbox.append((time.monotonic(), size, payload))
+    _outboxes_cond.notify_all()
+
+def take_batch(outbox):
+  max_messages = get_config().get('send_batch_max_messages',
+                                  DEFAULT_SEND_BATCH_MAX_MESSAGES)
+  max_bytes = get_config().get('send_batch_max_bytes',
+                               DEFAULT_SEND_BATCH_MAX_BYTES)
+  count = 0
+  total = 0
+  for _, size, _ in outbox:
+    if count >= max_messages or (count and (total + size) > max_bytes):
+      return count
+    count += 1
+    total += size
+  return None
+
+def flush_outbox(device, recipient, outbox, window):
+  retries = get_config().get('send_retries', DEFAULT_SEND_RETRIES)
+  delay = get_config().get('send_retry_delay', DEFAULT_SEND_RETRY_DELAY)
+  failures = 0
+  while True:
+    with _outboxes_cond:
+      if not outbox:
+        del _outboxes[(device, recipient)]
+        _outboxes_cond.notify_all()
+        return
+      timeout = max(outbox[0][0] + window - time.monotonic(), 0)
+      _outboxes_cond.wait_for(lambda: take_batch(outbox), timeout = timeout)
+      count = take_batch(outbox) or len(outbox)
+      items = outbox[:count]
+      del outbox[:count]
+    batch = [i[2] for i in items]
+    try:
+      send_payload(recipient,
+                   batch[0] if len(batch) == 1 else {'messages': batch},
+                   device = device)
+      failures = 0
+    except Exception:
+      failures += 1
+      with _outboxes_cond:
+        # Keep the batch ahead of anything queued while it was being sent
+        outbox[:0] = items
+        if failures > retries:
+          _unsent[(device, recipient)] = outbox
+          del _outboxes[(device, recipient)]
+          _outboxes_cond.notify_all()
+          raise
+      time.sleep(delay * 2**(failures - 1))
+
+def flush_outboxes():
+  with _outboxes_cond:
+    _outboxes_cond.wait_for(lambda: not _outboxes)
+
+def get_inbox(device = None):
+  device = device or get_this_devices()[0]
   inbox = missioncontrollitelib.receive(
     get_config()['mcbus_url'],
-    get_config()['devices'][this_device]['server_name'],
+    get_config()['devices'][device]['server_name'],
     verify = get_cert_path(),
+    pool = _pool,
   )
-  key = get_config()['devices'][this_device]['client_key']
-  return [missioncontrollitelib.decrypt(i, key) for i in inbox]
+  key = get_config()['devices'][device]['client_key']
+  messages = []
+  for i in inbox:
+    start = time.monotonic()
+    messages.append(missioncontrollitelib.decrypt(i, key))
+    record_latency('decrypt_latency', time.monotonic() - start)
+  return messages
 
-def run_cmd(sender, cmd, stdin):
+class StdinStream:
+  def __init__(self, key):
+    self.key = key
+    self.cond = threading.Condition()
+    self.chunks = {}
+    self.next_seq = 0
+    self.eof_seq = None
+    self.last_update = time.monotonic()
+
+  def put(self, seq, data, eof):
+    with self.cond:
+      if seq >= self.next_seq:
+        self.chunks[seq] = data
+      if eof:
+        self.eof_seq = seq
+      self.last_update = time.monotonic()
+      self.cond.notify_all()
+
+  def __iter__(self):
+    timeout = get_config().get('idle_timeout', DEFAULT_IDLE_TIMEOUT)
+    while True:
+      with self.cond:
+        if not self.cond.wait_for(lambda: self.next_seq in self.chunks,
+                                  timeout = timeout):
+          return
+        data = self.chunks.pop(self.next_seq)
+        done = self.next_seq == self.eof_seq
+        self.next_seq += 1
+      yield data
+      if done:
+        return
+
+def get_stdin_stream(sender, stream_id):
+  timeout = get_config().get('idle_timeout', DEFAULT_IDLE_TIMEOUT)
+  key = (sender, stream_id)
+  with _stdin_streams_lock:
+    now = time.monotonic()
+    for k, v in list(_stdin_streams.items()):
+      if (now - v.last_update) > timeout:
+        del _stdin_streams[k]
+    if not (stream := _stdin_streams.get(key)):
+      stream = _stdin_streams[key] = StdinStream(key)
+    return stream
+
+def feed_stdin(proc, stdin):
+  try:
+    for chunk in ((stdin,) if type(stdin) is bytes else stdin):
+      proc.stdin.write(chunk)
+      proc.stdin.flush()
+  except (BrokenPipeError, ValueError):
+    pass
+  finally:
+    try:
+      proc.stdin.close()
+    except BrokenPipeError:
+      pass
+    if type(stdin) is StdinStream:
+      with _stdin_streams_lock:
+        _stdin_streams.pop(stdin.key, None)
+
+# Moves the shell into the cgroup before it execs the command so nothing the
+# command starts can escape it
+CGROUP_WRAPPER = 'echo $$ > "$0/cgroup.procs" && exec "$@"'
+RLIMIT_WRAPPER = '; '.join((
+  'import os, sys, resource',
+  '[resource.setrlimit(getattr(resource, k), (int(s), int(h))) ' +
+    'for k, s, h in (i.split(":") for i in sys.argv[1].split(",") if i)]',
+  'os.execvp(sys.argv[2], sys.argv[2:])',
+))
+
+def get_rlimit_prefix(limits):
+  kill_timeout = limits.get('kill_timeout', DEFAULT_COMMAND_KILL_TIMEOUT)
+  rlimits = []
+  if (cpu := limits.get('rlimit_cpu')) is not None:
+    rlimits.append(('cpu', 'RLIMIT_CPU', cpu, cpu + kill_timeout))
+  if (mem := limits.get('rlimit_memory')) is not None:
+    rlimits.append(('as', 'RLIMIT_AS', mem, mem))
+  if not rlimits:
+    return []
+  if prlimit := shutil.which('prlimit'):
+    return [prlimit] + [f'--{name}={soft}:{hard}'
+                        for name, _, soft, hard in rlimits] + ['--']
+  return [sys.executable, '-c', RLIMIT_WRAPPER,
+          ','.join(f'{key}:{soft}:{hard}' for _, key, soft, hard in rlimits)]
+
+def apply_limits(cmd, limits):
+  # Limits are applied by wrapper commands rather than a preexec_fn, which
+  # isn't safe to use while the Server's other threads are running
+  if os.name == 'nt':
+    return cmd
+  prefix = []
+  if cgroup := limits.get('cgroup'):
+    prefix += ['/bin/sh', '-c', CGROUP_WRAPPER, cgroup]
+  if (scope := limits.get('systemd_scope')) and \
+     (systemd_run := shutil.which('systemd-run')):
+    prefix += [systemd_run, '--scope', '--quiet', '--collect']
+    if getattr(os, 'getuid', lambda: 0)() != 0:
+      prefix.append('--user')
+    if type(scope) is dict:
+      for k, v in scope.items():
+        prefix += ['-p', f'{k}={v}']
+  if (ionice_class := limits.get('ionice_class')) is not None and \
+     (ionice := shutil.which('ionice')):
+    prefix += [ionice, '-c', str(ionice_class)]
+    if (ionice_level := limits.get('ionice_level')) is not None:
+      prefix += ['-n', str(ionice_level)]
+  if nice := limits.get('nice'):
+    prefix += [shutil.which('nice') or 'nice', '-n', str(nice)]
+  return prefix + get_rlimit_prefix(limits) + cmd
+
+class HelperProc:
+  # Stands in for the Popen of a helper command run by a pooled worker
+  def __init__(self, path, worker, argv):
+    self.path = path
+    self.worker = worker
+    self.pid = worker[0].pid
+    self.returncode = None
+    stdin_r, stdin_w = os.pipe()
+    stdout_r, stdout_w = os.pipe()
+    try:
+      socket.send_fds(worker[1], [json.dumps({'argv': argv}).encode()],
+                      [stdin_r, stdout_w])
+    except OSError:
+      os.close(stdin_w)
+      os.close(stdout_r)
+      raise
+    finally:
+      os.close(stdin_r)
+      os.close(stdout_w)
+    self.stdin = open(stdin_w, 'wb')
+    self.stdout = open(stdout_r, 'rb')
+
+  def wait_for_exit(self, timeout):
+    proc, sock = self.worker
+    sock.settimeout(timeout)
+    try:
+      data = sock.recv(64*1024)
+    except (TimeoutError, BlockingIOError):
+      return None, None
+    except OSError:
+      data = b''
+    if not data:
+      # The worker died or was killed for exceeding its timeout
+      self.returncode = proc.wait()
+      sock.close()
+      release_helper_worker(self.path, None)
+      return self.returncode, None
+    result = json.loads(data)
+    self.returncode = result['rc']
+    release_helper_worker(self.path, self.worker)
+    return self.returncode, result['rusage']
+
+def get_helper_paths():
+  paths = get_config().get('helper_path')
+  if paths is None:
+    root = os.path.dirname(os.path.abspath(__file__))
+    paths = [os.path.join(root, i) for i in DEFAULT_HELPER_NAMES]
+  elif type(paths) is str:
+    paths = [paths]
+  return {os.path.realpath(i) for i in paths}
+
+def get_helper_argv(cmd):
+  helper_paths = get_helper_paths()
+  for idx in range(min(len(cmd), 2)):
+    if idx == 1 and not os.path.basename(cmd[0]).startswith('py'):
+      break
+    path = cmd[idx] if os.sep in cmd[idx] else shutil.which(cmd[idx])
+    if path and os.path.realpath(path) in helper_paths:
+      return os.path.realpath(path), cmd[idx+1:]
+  return None, None
+
+def acquire_helper_worker(path):
+  max_workers = get_config().get('helper_workers', DEFAULT_HELPER_WORKERS)
+  with _helper_workers_lock:
+    workers = _helper_workers.setdefault(path, {'idle': [], 'count': 0})
+    while workers['idle']:
+      worker = workers['idle'].pop()
+      if worker[0].poll() is None:
+        return worker
+      worker[1].close()
+      workers['count'] -= 1
+    if workers['count'] >= max_workers:
+      return None
+    workers['count'] += 1
+  try:
+    sock, child_sock = socket.socketpair(socket.AF_UNIX,
+                                         socket.SOCK_SEQPACKET)
+    with child_sock:
+      proc = subprocess.Popen((sys.executable, path, 'worker',
+                               '--fd', str(child_sock.fileno())),
+                              stdin = subprocess.DEVNULL,
+                              stdout = subprocess.DEVNULL,
+                              stderr = subprocess.DEVNULL,
+                              pass_fds = (child_sock.fileno(),),
+                              start_new_session = True)
+    return proc, sock
+  except OSError:
+    release_helper_worker(path, None)
+    return None
+
+def release_helper_worker(path, worker):
+  with _helper_workers_lock:
+    workers = _helper_workers[path]
+    if worker is None:
+      workers['count'] -= 1
+    else:
+      workers['idle'].append(worker)
+
+def start_helper_proc(cmd, limits):
+  if not hasattr(socket, 'send_fds') or \
+     not get_config().get('helper_workers', DEFAULT_HELPER_WORKERS) or \
+     any(limits.get(i) is not None for i in PROCESS_LIMITS):
+    return None
+  path, argv = get_helper_argv(cmd)
+  if not path or not (worker := acquire_helper_worker(path)):
+    return None
+  try:
+    return HelperProc(path, worker, argv)
+  except OSError:
+    worker[0].kill()
+    worker[0].wait()
+    worker[1].close()
+    release_helper_worker(path, None)
+    return None
+
+def signal_cmd(proc, sig):
+  try:
+    if hasattr(os, 'killpg'):
+      os.killpg(proc.pid, sig)
+    else:
+      os.kill(proc.pid, sig)
+  except ProcessLookupError:
+    pass
+
+def wait_for_exit(proc, timeout):
+  if type(proc) is HelperProc:
+    return proc.wait_for_exit(timeout)
+  if not hasattr(os, 'wait4'):
+    try:
+      return proc.wait(timeout = timeout), None
+    except subprocess.TimeoutExpired:
+      return None, None
+  deadline = time.monotonic() + timeout
+  delay = 0.0005
+  while True:
+    pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+    if pid:
+      proc.returncode = os.waitstatus_to_exitcode(status)
+      return proc.returncode, {
+        'user_cpu': rusage.ru_utime,
+        'system_cpu': rusage.ru_stime,
+        'max_rss': rusage.ru_maxrss,
+        'blocks_in': rusage.ru_inblock,
+        'blocks_out': rusage.ru_oublock,
+        'voluntary_switches': rusage.ru_nvcsw,
+        'involuntary_switches': rusage.ru_nivcsw,
+      }
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+      return None, None
+    delay = min(delay * 2, remaining, 0.05)
+    time.sleep(delay)
+
+def format_rusage(rusage):
+  # Pooled helper workers can only report their own lifetime peak RSS
+  if 'max_rss' in rusage:
+    rss = f"Max RSS: {rusage['max_rss']} KiB"
+  else:
+    rss = f"Worker Peak RSS: {rusage['worker_max_rss']} KiB"
+  return '\n'.join((
+    f"User CPU: {rusage['user_cpu']:.3f}s",
+    f"System CPU: {rusage['system_cpu']:.3f}s",
+    rss,
+    f"Block I/O: {rusage['blocks_in']} in, {rusage['blocks_out']} out",
+    f"Context Switches: {rusage['voluntary_switches']} voluntary, " +
+      f"{rusage['involuntary_switches']} involuntary",
+  ))
+
+def run_cmd(sender, cmd, stdin, limits = None, job_id = None, device = None):
+  try:
+    return run_cmd_internal(sender, cmd, stdin, limits or {}, job_id,
+                            device or get_this_devices()[0])
+  finally:
+    end_job(job_id)
+
+def run_cmd_internal(sender, cmd, stdin, limits, job_id, device):
   if type(cmd) is str:
     cmd = shlex.split(cmd)
   if type(stdin) is str:
     stdin = stdin.encode()
-  proc = subprocess.Popen(cmd,
-                          stdin = subprocess.PIPE,
-                          stdout = subprocess.PIPE,
-                          stderr = subprocess.STDOUT)
+  with _stats_lock:
+    command_name = _jobs.get(job_id, {}).get('command_name')
+  if not (proc := start_helper_proc(cmd, limits)):
+    kwargs = {}
+    if hasattr(os, 'killpg'):
+      kwargs['start_new_session'] = True
+    try:
+      proc = subprocess.Popen(apply_limits(cmd, limits),
+                              stdin = subprocess.PIPE,
+                              stdout = subprocess.PIPE,
+                              stderr = subprocess.STDOUT,
+                              **kwargs)
+    except (OSError, subprocess.SubprocessError, ValueError) as exc:
+      # The Client counts an Error as the command's final reply
+      return send(sender, [
+        {'title': 'CMD', 'body': shlex.join(cmd)},
+        {'title': 'Error', 'body': 'Failed to start command: ' + repr(exc)},
+      ], device = device, command_name = command_name)
+  update_job(job_id, state = 'running', since = time.monotonic(),
+             pid = proc.pid)
   if stdin:
-    subprocess.stdin.write(stdin)
+    threading.Thread(target = feed_stdin, args = (proc, stdin)).start()
+  else:
+    proc.stdin.close()
   os.set_blocking(proc.stdout.fileno(), False)
-  timeout = get_config().get('command_output_flush_timeout',
-                             DEFAULT_COMMAND_OUTPUT_FLUSH_TIMEOUT)
+  flush_timeout = get_config().get('command_output_flush_timeout',
+                                   DEFAULT_COMMAND_OUTPUT_FLUSH_TIMEOUT)
+  deadline = None
+  if (timeout := limits.get('timeout')) is not None:
+    deadline = time.monotonic() + timeout
+  kill_timeout = limits.get('kill_timeout', DEFAULT_COMMAND_KILL_TIMEOUT)
+  killed = None
   sections = [
     {'title': 'CMD', 'body': shlex.join(cmd)},
     {'title': 'PID', 'body': str(proc.pid)},
   ]
   while True:
-    try:
-      rc = proc.wait(timeout = timeout)
-    except subprocess.TimeoutExpired:
-      rc = None
+    wait_timeout = flush_timeout
+    if deadline is not None:
+      wait_timeout = max(min(wait_timeout, deadline - time.monotonic()), 0)
+    rc, rusage = wait_for_exit(proc, wait_timeout)
+    if rc is None and deadline is not None and time.monotonic() >= deadline:
+      if killed is None:
+        killed = 'SIGTERM'
+        signal_cmd(proc, signal.SIGTERM)
+        deadline = time.monotonic() + kill_timeout
+      elif killed == 'SIGTERM':
+        killed = 'SIGKILL'
+        signal_cmd(proc, getattr(signal, 'SIGKILL', signal.SIGTERM))
+        deadline = None
     if output := proc.stdout.read():
       if rc is None:
         send(sender, sections + [
           {'title': 'PARTIAL OUTPUT', 'body': output.decode()},
-        ])
+        ], device = device, command_name = command_name)
       else:
         sections.append({'title': 'OUTPUT', 'body': output.decode()})
     elif rc is not None:
       sections.append({'title': 'NO OUTPUT'})
     if rc is not None:
+      if killed:
+        sections.append({'title': 'TIMED OUT',
+                         'body': f'Exceeded {timeout}s timeout, sent {killed}'})
+      if rusage:
+        sections.append({'title': 'RESOURCE USAGE',
+                         'body': format_rusage(rusage)})
       sections.append({'title': 'RETURN CODE: ' + str(proc.returncode)})
-      return send(sender, sections)
+      return send(sender, sections, device = device,
+                  command_name = command_name)
+
+def get_effective_priority(item, now):
+  priority, job_id, since, _ = item
+  if priority <= PRIORITY_CLASSES['interactive']:
+    return priority, job_id
+  aging = get_config().get('priority_aging_interval',
+                           DEFAULT_PRIORITY_AGING_INTERVAL)
+  boost = int((now - since) / aging) if aging else 0
+  return max(priority - boost, PRIORITY_CLASSES['interactive']), job_id
+
+def dispatch_jobs():
+  max_concurrent = get_config().get('max_concurrent_commands',
+                                    DEFAULT_MAX_CONCURRENT_COMMANDS)
+  reserved = get_config().get('reserved_interactive_slots',
+                              DEFAULT_RESERVED_INTERACTIVE_SLOTS)
+  with _run_queue_lock:
+    now = time.monotonic()
+    for item in sorted(_run_queue,
+                       key = lambda i: get_effective_priority(i, now)):
+      # Aging only affects ordering, only interactive commands get the
+      # reserved slots
+      limit = max_concurrent
+      if item[0] > PRIORITY_CLASSES['interactive']:
+        limit = max(limit - reserved, 1)
+      if max_concurrent and item[0] > PRIORITY_CLASSES['emergency'] and \
+         _run_queue_state['running'] >= limit:
+        continue
+      _run_queue.remove(item)
+      _run_queue_state['running'] += 1
+      threading.Thread(target = run_job, args = item[3]).start()
 
-def handle_messages(messages):
+def submit_job(priority, job_id, args):
+  default = get_config().get('default_priority', DEFAULT_PRIORITY)
+  priority = PRIORITY_CLASSES.get(priority, PRIORITY_CLASSES[default])
+  with _run_queue_lock:
+    _run_queue.append((priority, job_id, time.monotonic(), args))
+  dispatch_jobs()
+
+def run_job(*args):
+  try:
+    run_cmd(*args)
+  finally:
+    with _run_queue_lock:
+      _run_queue_state['running'] -= 1
+    dispatch_jobs()
+
+def handle_messages(messages, device = None):
+  device = device or get_this_devices()[0]
   for message in messages:
     missioncontrollitelib.watchdog_tick()
-    command_name = message['command_name']
+    with _stats_lock:
+      _stats['messages_handled'] += 1
     sender = message['sender']
-    this_device = get_config()['this_device']
-    cmd = get_config()['devices'][this_device]['commands'].get(command_name)
+    if 'command_name' not in message and 'stdin_stream' in message:
+      get_stdin_stream((device, sender), message['stdin_stream']).put(
+        message['seq'],
+        base64.b85decode(message.get('data', '')),
+        message.get('eof'),
+      )
+      continue
+    command_name = message['command_name']
+    if command_name == STATS_COMMAND_NAME:
+      send(sender, get_stats_sections(), device = device,
+           command_name = command_name)
+      continue
+    cmd = get_config()['devices'][device]['commands'].get(command_name)
     if cmd:
       stdin = None
+      limits = {}
+      priority = get_config().get('default_priority', DEFAULT_PRIORITY)
       if type(cmd) is dict:
+        limits = cmd
+        priority = cmd.get('priority', priority)
         args = cmd.get('args', [])
         if cmd.get('accepts_stdin'):
-          stdin = message.get('stdin', '')
+          if (stream_id := message.get('stdin_stream')) is not None:
+            stdin = get_stdin_stream((device, sender), stream_id)
+          else:
+            stdin = message.get('stdin', '')
         cmd = cmd['cmd']
         if type(cmd) is list:
           cmd = shlex.join(cmd)
         for arg in args:
           v = message.get('args', {}).get(arg, '')
           cmd = cmd.replace('{' + arg + '}', shlex.quote(v))
-      threading.Thread(target = run_cmd,
-                       args = (sender, cmd, stdin)).start()
+      job_id = start_job(command_name, priority = priority, device = device)
+      submit_job(priority, job_id,
+                 (sender, cmd, stdin, limits, job_id, device))
     else:
       send(sender, [{'title': 'Error',
-                     'body': 'Invalid Request: ' + pprint.pformat(message)}])
+                     'body': 'Invalid Request: ' + pprint.pformat(message)}],
+           device = device, command_name = command_name)
 
 def do_test():
   print('Running basic sanity/smoke tests...')
-  this_device = get_config()['this_device']
-  name = get_config()['devices'][this_device]['server_name']
-  try:
-    send(name, 'testsections')
-    actual_client_key = get_config()['devices'][this_device]['client_key']
-    server_key = get_config()['devices'][this_device]['server_key']
-    get_config()['devices'][this_device]['client_key'] = server_key
-    inbox = get_inbox()
-    get_config()['devices'][this_device]['client_key'] = actual_client_key
-    if inbox != [{'sections': 'testsections'}]:
-      raise ValueError(f'Unexpected inbox contents: {inbox}')
-  except urllib.error.URLError:
-    print('WARNING: device offline, bus tests skipped')
+  for this_device in get_this_devices():
+    name = get_config()['devices'][this_device]['server_name']
+    try:
+      send(name, 'testsections', device = this_device)
+      flush_outboxes()
+      actual_client_key = get_config()['devices'][this_device]['client_key']
+      server_key = get_config()['devices'][this_device]['server_key']
+      get_config()['devices'][this_device]['client_key'] = server_key
+      inbox = get_inbox(this_device)
+      get_config()['devices'][this_device]['client_key'] = actual_client_key
+      if inbox != [{'sections': 'testsections'}]:
+        raise ValueError(f'Unexpected inbox contents: {inbox}')
+    except urllib.error.URLError:
+      print(f'WARNING: {this_device} offline, bus tests skipped')
   now = missioncontrollitelib.watchdog_tick()
   last = missioncontrollitelib.get_last_watchdog_tick()
   if now != last:
@@ -114,22 +723,256 @@ def do_test():
     raise ValueError('missing or empty cert path')
   print('Tests passed!')
 
+class BenchBus:
+  def __init__(self):
+    self.cond = threading.Condition()
+    self.inboxes = {}
+    self.sends = 0
+
+  def send(self, mcbus_url, recipient, key, payload, verify = True,
+           pool = None):
+    if 'cryptography' in dir(missioncontrollitelib):
+      if type(key) is str:
+        key = base64.b85decode(key)
+      payload = base64.b85encode(missioncontrollitelib.encrypt(payload, key))
+    with self.cond:
+      self.sends += 1
+      self.inboxes.setdefault(recipient, []).append(payload)
+      self.cond.notify_all()
+
+  def receive(self, mcbus_url, name, verify = True, pool = None,
+              timeout = 0.1):
+    with self.cond:
+      self.cond.wait_for(lambda: self.inboxes.get(name), timeout = timeout)
+      return self.inboxes.pop(name, [])
+
+def count_child_processes():
+  count = 0
+  try:
+    for pid in os.listdir('/proc'):
+      if not pid.isdigit():
+        continue
+      try:
+        with open(f'/proc/{pid}/stat', 'rb') as f:
+          stat = f.read()
+      except OSError:
+        continue
+      if int(stat[stat.rindex(b')')+2:].split()[1]) == os.getpid():
+        count += 1
+  except FileNotFoundError:
+    with _stats_lock:
+      count = sum((1 for i in _jobs.values() if i['state'] == 'running'))
+  return count
+
+def percentile(values, p):
+  if not values:
+    return 0
+  return sorted(values)[min(int(len(values) * p), len(values) - 1)]
+
+def do_bench():
+  named_args = dict(zip(sys.argv[2::2], sys.argv[3::2]))
+  if trace_path := named_args.get('--trace'):
+    with open(trace_path, 'r') as f:
+      trace = [json.loads(line) for line in f if line.strip()]
+  else:
+    count = int(named_args.get('--messages', DEFAULT_BENCH_MESSAGES))
+    burst = int(named_args.get('--burst', DEFAULT_BENCH_BURST))
+    interval = float(named_args.get('--interval',
+                                    DEFAULT_BENCH_BURST_INTERVAL))
+    names = list(BENCH_COMMANDS.keys())
+    trace = [{'t': (i // burst) * interval,
+              'command_name': names[i % len(names)]} for i in range(count)]
+  if record_path := named_args.get('--record'):
+    with open(record_path, 'w') as f:
+      f.write(''.join((json.dumps(i) + '\n' for i in trace)))
+  sample_interval = float(named_args.get('--sample',
+                                         DEFAULT_BENCH_SAMPLE_INTERVAL))
+  bench_timeout = float(named_args.get('--timeout', DEFAULT_BENCH_TIMEOUT))
+
+  try:
+    config = {k: v for k,v in get_config().items() if k != 'devices'}
+  except (FileNotFoundError, KeyError):
+    config = {}
+  key = base64.b85encode(random_bytes(64)).decode()
+  commands = {}
+  for name, code in BENCH_COMMANDS.items():
+    commands[name] = {
+      'cmd': shlex.join((sys.executable, '-c', code)),
+      'priority': 'bulk' if name == 'bulk' else DEFAULT_PRIORITY,
+    }
+  # Commands recorded from real traffic run as a stub, quick by default
+  for message in trace:
+    if (name := message['command_name']) not in commands:
+      stub = message.get('stub', 'quick')
+      commands[name] = commands[stub if stub in BENCH_COMMANDS else 'quick']
+  config |= {
+    'mcbus_url': 'bench://',
+    'this_device': 'BENCH',
+    'devices': {'BENCH': {
+      'server_name': 'bench_server',
+      'server_key': key,
+      'client_key': key,
+      'commands': commands,
+    }},
+  }
+  bus = BenchBus()
+  globals()['get_config'] = lambda **kwargs: config
+  globals()['get_cert_path'] = lambda **kwargs: None
+  missioncontrollitelib.send = bus.send
+  missioncontrollitelib.receive = bus.receive
+  missioncontrollitelib.watchdog_tick = lambda name = None: time.time()
+  if 'cryptography' not in dir(missioncontrollitelib):
+    print('WARNING: cryptography not installed, encryption skipped')
+    missioncontrollitelib.decrypt = lambda payload, key: payload
+
+  current = {}
+  dispatch_latencies = []
+  started = {}
+  bench_start_job = start_job
+  def start_job_hook(command_name, priority = DEFAULT_PRIORITY,
+                     device = None):
+    job_id = bench_start_job(command_name, priority = priority,
+                             device = device)
+    started[job_id] = current['sent']
+    return job_id
+  bench_update_job = update_job
+  def update_job_hook(job_id, **kwargs):
+    if kwargs.get('state') == 'running':
+      dispatch_latencies.append(time.monotonic() - started.pop(job_id))
+    bench_update_job(job_id, **kwargs)
+  globals()['start_job'] = start_job_hook
+  globals()['update_job'] = update_job_hook
+
+  print(f'Replaying {len(trace)} message(s)...')
+  state = {'done': False, 'results': 0}
+  def poll():
+    while not state['done']:
+      inbox = get_inbox()
+      with _stats_lock:
+        _stats['polls'] += 1
+        _stats['empty_polls'] += (0 if inbox else 1)
+      # One at a time so each job is matched with its own send time
+      for message in inbox:
+        current['sent'] = message.get('bench_sent')
+        handle_messages([message])
+  poller = threading.Thread(target = poll)
+  poller.start()
+  samples = []
+  start = time.monotonic()
+  next_sample = start
+  pending = list(trace)
+  try:
+    while state['results'] < len(trace) and \
+          (time.monotonic() - start) < bench_timeout:
+      now = time.monotonic()
+      while pending and (now - start) >= pending[0].get('t', 0):
+        message = pending.pop(0)
+        bus.send(None, 'bench_server', key, {
+          'command_name': message['command_name'],
+          'sender': 'bench_client',
+          'args': message.get('args', {}),
+          'stdin': message.get('stdin'),
+          'bench_sent': time.monotonic(),
+        })
+      for reply in bus.receive(None, 'bench_client', timeout = 0.05):
+        reply = missioncontrollitelib.decrypt(reply, key)
+        for r in reply.get('messages', [reply]):
+          # Errors e.g. for an invalid request are final replies too
+          if any(i['title'].startswith('RETURN CODE') or i['title'] == 'Error'
+                 for i in r['sections']):
+            state['results'] += 1
+      if now >= next_sample:
+        with _run_queue_lock:
+          queued = len(_run_queue)
+          running = _run_queue_state['running']
+        samples.append((now - start, threading.active_count(),
+                        count_child_processes(), get_rss(), queued, running))
+        next_sample += sample_interval
+  finally:
+    state['done'] = True
+    poller.join()
+    flush_outboxes()
+  elapsed = time.monotonic() - start
+
+  print('')
+  print(f"Completed {state['results']}/{len(trace)} command(s) " +
+        f"in {elapsed:.2f}s ({state['results'] / elapsed:.1f}/s)")
+  print(f'Bus sends: {bus.sends - len(trace)} for the replies')
+  print('Dispatch latency (ms): ' + ', '.join((
+    f'{label} {1000 * percentile(dispatch_latencies, p):.1f}'
+    for label, p in (('p50', .5), ('p90', .9), ('p99', .99), ('max', 1))
+  )))
+  print('')
+  print(f"{'time':>7} {'threads':>7} {'children':>8} {'queued':>6} " +
+        f"{'running':>7}  rss")
+  for t, threads, children, rss, queued, running in samples:
+    print(f'{t:>6.1f}s {threads:>7} {children:>8} {queued:>6} ' +
+          f'{running:>7}  {rss}')
+
+def is_busy(pollers):
+  return any((i not in pollers and not i.daemon
+              for i in threading.enumerate()))
+
+def poll_inboxes(devices, state):
+  idle_timeout = get_config().get('idle_timeout', DEFAULT_IDLE_TIMEOUT)
+  try:
+    while not state['stop']:
+      if (time.time() - state['last_request']) > idle_timeout and \
+         not is_busy(state['pollers']):
+        break
+      try:
+        device = devices.get(timeout = 1)
+      except queue.Empty:
+        continue
+      try:
+        missioncontrollitelib.watchdog_tick()
+        inbox = get_inbox(device)
+        with _stats_lock:
+          _stats['polls'] += 1
+          _stats['empty_polls'] += (0 if inbox else 1)
+        if len(inbox) > 0:
+          state['last_request'] = time.time()
+          handle_messages(inbox, device)
+      finally:
+        devices.put(device)
+  finally:
+    state['stop'] = True
+
+def adopt_connection(url, verify, conn):
+  bus = get_config()['mcbus_url']
+  parts = urllib.parse.urlsplit(url)
+  bus_parts = urllib.parse.urlsplit(bus)
+  if (parts.scheme, parts.netloc) == (bus_parts.scheme, bus_parts.netloc) \
+     and (parts.scheme != 'https' or
+          os.path.abspath(verify) == os.path.abspath(get_cert_path())):
+    _pool.put(bus, get_cert_path(), conn)
+  else:
+    conn.close()
+
 def daemon_main():
   last = missioncontrollitelib.get_last_watchdog_tick()
   if (time.time() - last) <= get_config().get('watchdog_timeout',
                                               DEFAULT_WATCHDOG_TIMEOUT):
     return
-  idle_timeout = get_config().get('idle_timeout', DEFAULT_IDLE_TIMEOUT)
-  last_request = time.time()
+  devices = queue.Queue()
+  for device in get_this_devices():
+    devices.put(device)
+  connections = get_config().get('max_poll_connections', devices.qsize())
+  connections = max(min(connections, devices.qsize()), 1)
+  state = {'last_request': time.time(), 'stop': False}
+  pollers = [threading.Thread(target = poll_inboxes, args = (devices, state))
+             for _ in range(connections - 1)]
+  state['pollers'] = set(pollers) | {threading.current_thread()}
+  _stats['wake_time'] = time.monotonic()
   try:
-    while (time.time() - last_request) <= idle_timeout or \
-          len(threading.enumerate()) > 1:
-      missioncontrollitelib.watchdog_tick()
-      inbox = get_inbox()
-      if len(inbox) > 0:
-        last_request = time.time()
-        handle_messages(inbox)
+    for poller in pollers:
+      poller.start()
+    poll_inboxes(devices, state)
   finally:
+    state['stop'] = True
+    for poller in pollers:
+      if poller.is_alive():
+        poller.join()
     missioncontrollitelib.clear_watchdog_tick()
 
 def main():
@@ -137,6 +980,8 @@ def main():
     return daemon_main()
   elif '--test' in sys.argv[1:2]:
     return do_test()
+  elif '--bench' in sys.argv[1:2]:
+    return do_bench()
   elif len(sys.argv) > 1:
     print(f'WARNING: invalid arg(s): {sys.argv}')
     print('         launching background daemon')